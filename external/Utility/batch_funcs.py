@@ -0,0 +1,246 @@
+# Batch processing of recordingList sessions on a process pool
+# Each session runs its stages in a separate worker, stage outputs are saved per session in progress_dir
+# (which also marks the stage as done, for resuming) and results come back in recordingList order.
+#
+# results, report = bfun.run_sessions_batch(info.recordingList, ['edges', 'licks', 'dff', 'epochs', 'responsive'],
+#                                           params, n_workers=6, progress_dir=os.path.join(info.analysisPath, 'batch'))
+
+import numpy as np
+import pandas as pd
+import os
+import glob
+import pickle
+import traceback
+import multiprocessing
+from time import time
+import LakLabAnalysis.Utility.utils_funcs as utils
+
+default_batch_params = {
+    'stChanName_reward': 'reward_echo',
+    'twoPChannelName': '2p_frame',
+    'stChanName_lick': 'lick',
+    'infoColumnForLicks': 'paqFileName', # .pkl with the lick channel
+    'fRate': 20000, # paqIO sampling rate (overwritten by 'sample_rate' in the lick file)
+    'lickInterval_s': 0.08,
+    'preRewardTime': 3,
+    'preStim_s': 3,
+    'postStim_s': 6,
+    'fRate_imaging': 15,
+    'dtype': None, # np.float32 halves the memory of the trial blocks
+    'preprocess_flu': {}, # arguments of utils.preprocess_flu
+    'trialTypeColumn': 'stimulusType', # beh_df column used to split trials for 'responsive'
+    'responsive': {}, # params of utils.test_responsive_acrossTrialTypes
+    'normalise': False,
+    'p_alpha': 0.05,
+    'cache_dir': None, # utils.NpyCache folder for the preprocessed flu
+    'cache_GB': 20,
+}
+
+def session_files(session_info):
+    """ Paths used by the stages, from a one-row recordingList. The frame clock is the _imaging_frames.txt written 
+    next to the .paq in rawBlockPath by stage_edges, otherwise the first *_imaging_frames.txt in rawBlockPath """
+    rawBlockPath = session_info.rawBlockPath[0]
+    paq_files = sorted(glob.glob(os.path.join(rawBlockPath, '*.paq')))
+    frame_files = sorted(glob.glob(os.path.join(rawBlockPath, '*_imaging_frames.txt')))
+    if len(paq_files):
+        frameClock = paq_files[0].replace('.paq', '_imaging_frames.txt')
+    else:
+        frameClock = frame_files[0] if len(frame_files) else None
+    return {'imData': os.path.join(session_info.analysisPath[0], 'imaging-data.pkl'),
+            'behWithLicks': session_info.behFileName[0].replace('.csv', '_withLicks.csv'),
+            'paq': paq_files[0] if len(paq_files) else None,
+            'frameClock': frameClock}
+
+def stage_edges(session_info, outputs, params):
+    """ Reward and imaging frame edges from the raw PAQ file (saved next to it, see extract_paq_data_frame) """
+    files = session_files(session_info)
+    assert files['paq'] is not None, 'No *.paq in ' + session_info.rawBlockPath[0]
+    _, frame_count_reward = utils.extract_paq_data_frame(files['paq'], params['stChanName_reward'],
+                                                         twoPChannelName=params['twoPChannelName'])
+    frame_clock = utils.load_frame_count(files['frameClock'])
+    return {'reward_frames': frame_count_reward, 'frame_clock': frame_clock}
+
+def stage_licks(session_info, outputs, params):
+    """ Lick times and licks binned per trial, see utils.preprocessLicks """
+    paqData = pd.read_pickle(session_info[params['infoColumnForLicks']][0])
+    beh_df = pd.read_csv(session_info.behFileName[0])
+    fRate = paqData['sample_rate'] if 'sample_rate' in paqData.keys() else params['fRate']
+    rig = session_info['rig'][0] if 'rig' in session_info.columns else False
+    licks, session_lick = utils.preprocessLicks(paqData, beh_df, 'stimulusOnsetTime', preStimTime=params['preRewardTime'],
+                                                stChanName=params['stChanName_lick'],
+                                                lickInterval=params['lickInterval_s']*fRate, fRate=fRate, rig=rig)
+    return {'licks': licks, 'session_lick': session_lick}
+
+def stage_dff(session_info, outputs, params):
+    """ Preprocessed dF/F (cell x time) of imaging-data.pkl, see utils.preprocess_flu """
+    imDataPath = session_files(session_info)['imData']
+    cache = None if params['cache_dir'] is None else utils.NpyCache(params['cache_dir'], max_GB=params['cache_GB'])
+    flu = utils.preprocess_flu_cached(imDataPath, blockName=session_info.blockName[0], cache=cache,
+                                      **{**params['preprocess_flu'], 'plot': False})
+    return {'flu': np.asarray(flu)}
+
+def stage_epochs(session_info, outputs, params):
+    """ dF/F split into trials (cell x time x trial, NaN padded), and per trial type (imaged trials only), see utils.epoch_flu_to_stimuli """
+    files = session_files(session_info)
+    if 'frame_clock' in outputs:
+        frame_clock = outputs['frame_clock']
+    else:
+        # same file as stage_edges writes (see session_files)
+        assert files['frameClock'] is not None and os.path.exists(files['frameClock']), \
+            'No *_imaging_frames.txt in ' + session_info.rawBlockPath[0]
+        frame_clock = utils.load_frame_count(files['frameClock'])
+    beh_df = pd.read_csv(files['behWithLicks'])
+
+    dffTrace = utils.epoch_flu_to_stimuli(outputs['flu'], frame_clock, beh_df, preStim_s=params['preStim_s'],
+                                          postStim_s=params['postStim_s'], fRate=params['fRate_imaging'],
+                                          fs=params['fRate'], dtype=params['dtype'])
+
+    # trials outside of the imaging are all NaN, they stay in dffTrace (one trial per beh_df row) but not per trial type
+    trialTypes = beh_df[params['trialTypeColumn']]
+    is_imaged = ~np.all(np.isnan(dffTrace), axis=(0, 1))
+    dffTrace_aligned = {tType: dffTrace[:, :, np.where((trialTypes == tType) & is_imaged)[0]] 
+                        for tType in np.unique(trialTypes.dropna())}
+    return {'dffTrace': dffTrace, 'dffTrace_aligned': dffTrace_aligned}
+
+def stage_responsive(session_info, outputs, params):
+    """ Cells responding to any trial type, see utils.test_responsive_acrossTrialTypes """
+    responsive_params = {'pre_stim_s': params['preStim_s'], 'post_stim_s': params['postStim_s'], **params['responsive']}
+    pvals, significant_cells = utils.test_responsive_acrossTrialTypes(outputs['dffTrace_aligned'], responsive_params,
+                                                                      frate=params['fRate_imaging'],
+                                                                      normalise=params['normalise'],
+                                                                      p_alpha=params['p_alpha'])
+    return {'pvals': pvals, 'significant_cells': significant_cells}
+
+# stage name: (function, stages it needs the outputs of)
+batch_stages = {'edges': (stage_edges, []),
+                'licks': (stage_licks, []),
+                'dff': (stage_dff, []),
+                'epochs': (stage_epochs, ['dff']),
+                'responsive': (stage_responsive, ['epochs']),}
+
+def stage_output_path(progress_dir, blockName, stage):
+    return os.path.join(progress_dir, str(blockName), stage + '.pkl')
+
+def check_not_all_nan(stage_outputs, stage):
+    """ Raises a ValueError if an output of a stage (array, or dict of arrays) is entirely NaN,
+    e.g. p-values of a session whose trials all fall outside the imaging, so the session is reported as failed """
+    for name, output in stage_outputs.items():
+        arrays = list(output.values()) if isinstance(output, dict) else [output]
+        arrays = [np.asarray(arr) for arr in arrays if isinstance(arr, np.ndarray) and np.issubdtype(arr.dtype, np.floating)]
+        if len(arrays) and sum(arr.size for arr in arrays) and all(np.isnan(arr).all() for arr in arrays):
+            raise ValueError(f"Stage '{stage}' output '{name}' is all NaN")
+
+def run_session(session_info, stages, params, progress_dir=None, resume=True, return_stages=None):
+    """ Runs stages (in order) for one session, never raises: failures are returned with their traceback
+    :param: session_info  - one-row recordingList (index 0)
+    :output: result       - dict with blockName, status ('done'/'failed'), failedStage, error, time_s,
+                            and outputs {stage: outputs} for return_stages
+    """
+    blockName = session_info.blockName[0]
+    return_stages = stages if return_stages is None else return_stages
+    # finished stages are only loaded if a stage still to run (or return_stages) needs their outputs
+    is_done = {stage: resume and (progress_dir is not None) and os.path.exists(stage_output_path(progress_dir, blockName, stage))
+               for stage in stages}
+    needed_later = {req for stage in stages if not is_done[stage] for req in batch_stages[stage][1]}
+    result = {'blockName': blockName, 'status': 'done', 'failedStage': None, 'error': None, 'outputs': {}}
+    outputs = {} # outputs of all stages so far, available to the next stages
+    t0 = time()
+    for stage in stages:
+        output_path = None if progress_dir is None else stage_output_path(progress_dir, blockName, stage)
+        try:
+            if is_done[stage]:
+                if (stage in needed_later) or (stage in return_stages):
+                    stage_outputs = pd.read_pickle(output_path)
+                else:
+                    continue
+            else:
+                stage_fun, _ = batch_stages[stage]
+                stage_outputs = stage_fun(session_info, outputs, params)
+                check_not_all_nan(stage_outputs, stage)
+                if output_path is not None:
+                    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+                    with open(output_path + '.tmp', 'wb') as f:
+                        pickle.dump(stage_outputs, f, protocol=pickle.HIGHEST_PROTOCOL)
+                    os.replace(output_path + '.tmp', output_path) # marks the stage as done
+        except Exception: # incl. MemoryError from the worker memory limit
+            result.update({'status': 'failed', 'failedStage': stage, 'error': traceback.format_exc()})
+            break
+        outputs.update(stage_outputs)
+        if stage in return_stages:
+            result['outputs'][stage] = stage_outputs
+    result['time_s'] = time() - t0
+    return result
+
+def limit_worker_memory(memory_limit_GB):
+    """ Pool initializer: caps the address space of each worker (Linux/macOS), sessions going above it fail with MemoryError """
+    if memory_limit_GB is None:
+        return
+    try:
+        import resource
+    except ImportError:
+        print('Worker memory limit is not supported on this OS, running without it')
+        return
+    limit = int(memory_limit_GB * 1e9)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+def run_session_batch_task(task):
+    session_info, stages, params, progress_dir, resume, return_stages = task
+    return run_session(session_info, stages, params, progress_dir=progress_dir, resume=resume, return_stages=return_stages)
+
+def run_sessions_batch(recordingList, stages, params=None, n_workers=None, memory_limit_GB=None,
+                       progress_dir=None, resume=True, return_stages=None, sessions=None):
+    """ Runs per-session stages for every session of recordingList on a pool of processes
+    :param: recordingList   - info.recordingList (given by mfun.analysis())
+    :param: stages          - list of stage names, in order: 'edges', 'licks', 'dff', 'epochs', 'responsive' (see batch_stages)
+    :param: params          - overrides of default_batch_params
+    :param: n_workers       - number of processes (default: number of CPUs - 1); 1 runs in this process (e.g. for debugging)
+    :param: memory_limit_GB - maximum memory of each worker; every session also gets a fresh worker so memory is released
+    :param: progress_dir    - folder where the outputs of each stage are saved per session (progress_dir/blockName/stage.pkl)
+    :param: resume          - skip stages already saved in progress_dir
+    :param: return_stages   - stages whose outputs are returned (default all), e.g. ['responsive'] to keep
+                              the trial blocks on disk only
+    :param: sessions        - list of blockNames to run (default all)
+
+    :output: results        - list of dicts (see run_session), in recordingList order
+    :output: report         - dataframe with blockName, status, failedStage, error and time_s of every session
+    """
+    params = {**default_batch_params, **({} if params is None else params)}
+    for i, stage in enumerate(stages):
+        assert stage in batch_stages, f'Unknown stage {stage}, choose from {list(batch_stages.keys())}'
+        for req in batch_stages[stage][1]:
+            assert req in stages[:i], f'Stage {stage} needs stage {req} to run before it'
+    if (return_stages is not None) and (progress_dir is None):
+        print('WARNING: stages not in return_stages are only kept if progress_dir is given')
+    if n_workers is None:
+        n_workers = max(1, multiprocessing.cpu_count() - 1)
+
+    session_inds = range(len(recordingList)) if sessions is None else \
+                   [i for i in range(len(recordingList)) if recordingList.blockName.iloc[i] in sessions]
+    tasks = [(recordingList.iloc[[i]].reset_index(drop=True), stages, params, progress_dir, resume, return_stages)
+             for i in session_inds]
+    print(f'Running {stages} for {len(tasks)} sessions on {n_workers} worker(s)')
+
+    results = []
+    if n_workers == 1:
+        if memory_limit_GB is not None:
+            print('memory_limit_GB is only applied to worker processes (n_workers > 1)')
+        results_iter = map(run_session_batch_task, tasks)
+    else:
+        pool = multiprocessing.Pool(n_workers, initializer=limit_worker_memory, initargs=(memory_limit_GB,), maxtasksperchild=1)
+        results_iter = pool.imap(run_session_batch_task, tasks, chunksize=1) # keeps the order of tasks
+    try:
+        for result in results_iter:
+            print(f"{result['blockName']}: {result['status']}" +
+                  (f" at {result['failedStage']}" if result['status'] == 'failed' else '') + f" ({result['time_s']:.1f}s)")
+            results.append(result)
+    finally:
+        if n_workers > 1:
+            pool.close()
+            pool.join()
+
+    report = pd.DataFrame([{k: v for k, v in result.items() if k != 'outputs'} for result in results],
+                          columns=['blockName', 'status', 'failedStage', 'error', 'time_s'])
+    n_failed = np.sum(report.status == 'failed')
+    if n_failed:
+        print(f'{n_failed} / {len(report)} sessions failed, see report.error')
+    return results, report
@@ -0,0 +1,143 @@
+# Benchmarks for the array engines in utils_funcs
+# Run as a script or call the functions from a notebook, e.g. benchmark_epoching(n_trials=100)
+
+import numpy as np
+import pandas as pd
+import time
+from scipy import stats
+import LakLabAnalysis.Utility.utils_funcs as utils
+
+def timeit_best(fun, repeats=3):
+    """ Returns the best wall-clock time (s) of repeats calls of fun() and the output of the last call
+    """
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        output = fun()
+        times.append(time.perf_counter() - t0)
+    return np.min(times), output
+
+def flu_splitter_dstack(flu, t_starts, pre_frames, post_frames):
+    """ Previous flu_splitter (one np.dstack per trial), kept as the reference for benchmark_epoching
+    """
+    initial = True
+    for trial, t_start in enumerate(t_starts):
+        if ((t_start-pre_frames) > 0 ) & ((t_start+post_frames)<flu.shape[1]):
+            flu_chunk = flu[:, t_start-pre_frames:t_start+post_frames]
+            if initial == True:
+                trial_flu = flu_chunk
+                initial = False
+            else:
+                trial_flu = np.dstack((trial_flu, flu_chunk))
+    return trial_flu
+
+def benchmark_epoching(n_cells=1000, n_frames=60000, n_trials=400, fRate=15, preStim_s=3, postStim_s=6,
+                       repeats=3, run_legacy=True, seed=0):
+    """ Times np.dstack trial splitting against utils.epoch_trials on a synthetic session
+    :param: n_cells, n_frames, n_trials - size of the synthetic session (default 1000 cells x 60k frames x 400 trials)
+    :param: fRate, preStim_s, postStim_s - trial window as in flu_preprocess_splitter
+    :param: repeats    - number of repeats, best time is reported (legacy path is run once)
+    :param: run_legacy - False skips the (slow) dstack path
+    :output: results   - dataframe with method, seconds, speedup and output MB
+    """
+    rng = np.random.default_rng(seed)
+    flu = rng.standard_normal((n_cells, n_frames))
+    pre_frames, post_frames = int(np.ceil(preStim_s*fRate)), int(np.ceil(postStim_s*fRate))
+    # equally spaced trials with the first one inside the recording
+    spacing = (n_frames - pre_frames - post_frames) // n_trials
+    t_starts = pre_frames + 1 + spacing*np.arange(n_trials)
+    jittered = t_starts + rng.integers(0, max(1, spacing//2), n_trials)
+    print('Synthetic session: ' + str(n_cells) + ' cells x ' + str(n_frames) + ' frames x ' + str(n_trials) + ' trials')
+
+    methods = {'epoch_trials': lambda: utils.epoch_trials(flu, jittered, pre_frames, post_frames),
+               'epoch_trials float32': lambda: utils.epoch_trials(flu, jittered, pre_frames, post_frames, dtype=np.float32),
+               'epoch_trials view': lambda: utils.epoch_trials(flu, t_starts, pre_frames, post_frames, as_view=True),}
+    if run_legacy:
+        methods = {'dstack (legacy)': lambda: flu_splitter_dstack(flu, jittered, pre_frames, post_frames), **methods}
+
+    results, reference = [], None
+    for method, fun in methods.items():
+        seconds, output = timeit_best(fun, repeats=1 if 'legacy' in method else repeats)
+        if method == 'epoch_trials':
+            reference = output
+        elif 'legacy' in method:
+            legacy_output = output
+        results.append({'method': method, 'seconds': seconds,
+                        'outputMB': 0 if np.shares_memory(output, flu) else output.nbytes/1e6})
+        print(method + ': ' + str(np.round(seconds, 4)) + ' s')
+    if run_legacy:
+        assert np.array_equal(legacy_output, reference), 'epoch_trials does not match the dstack output'
+
+    results = pd.DataFrame(results)
+    results['speedup'] = results.seconds.iloc[0] / results.seconds
+    return results
+
+def test_responsive_acrossTrialTypes_loop(dffTrace_aligned, frate=15, normalise=False, pre_stim_s=3, ttest_pre_stim_s=2, 
+                                          ttest_post_stim_s=4, p_alpha=0.05):
+    """ Previous test_responsive_acrossTrialTypes (copies and normalises each trial type's trace), kept as the reference for benchmark_responsive
+    """
+    startframe = int(np.ceil((pre_stim_s-ttest_pre_stim_s)*frate))
+    endframe = int(np.ceil((pre_stim_s+ttest_post_stim_s)*frate))
+    ttest_pre = int(np.ceil(ttest_pre_stim_s)*frate)
+    pval_alltrialTypes, significant_cells = {}, []
+    for tType in dffTrace_aligned.keys():
+        dff_tType = dffTrace_aligned[tType][:,range(startframe, endframe),:]
+        if normalise:
+            dff_tType = utils.dFF_BaselineNormalisation(dff_tType, range(int(np.ceil(ttest_pre_stim_s*frate))), 3)
+        meandff_pre = np.nanmean(dff_tType[:,:ttest_pre,:], axis=1)
+        meandff_post = np.nanmean(dff_tType[:,ttest_pre:,:], axis=1)
+        _, pvals = stats.wilcoxon(meandff_pre, meandff_post, axis=1)
+        pval_alltrialTypes[tType] = pvals
+        significant_cells.append(np.where(pvals<p_alpha)[0])
+    return pval_alltrialTypes, np.unique(utils.flatten_lists(significant_cells))
+
+def benchmark_responsive(sizes=None, n_frames=135, fRate=15, trialTypes=None, n_perm=1000, repeats=3, seed=0):
+    """ Times the responsiveness tests (normalised, as in the batch runner) on synthetic sessions of increasing size
+    :param: sizes      - list of (n_cells, n_trials per trial type), default [(100, 50), (500, 100), (1000, 200), (2000, 300)]
+    :param: trialTypes - names of the synthetic trial types, default ['100%', '50%', '0%']
+    :param: n_frames   - frames per trial (default -3s to +6s at 15 fps)
+    :param: n_perm     - permutations of the permutation test (0 skips it)
+    :param: repeats    - number of repeats, best time is reported
+    :output: results   - dataframe with n_cells, n_trials, method, seconds and speedup vs the loop
+    """
+    sizes = [(100, 50), (500, 100), (1000, 200), (2000, 300)] if sizes is None else sizes
+    trialTypes = ['100%', '50%', '0%'] if trialTypes is None else trialTypes
+    rng = np.random.default_rng(seed)
+    params = {'pre_stim_s': 3, 'post_stim_s': 6, 'ttest_pre_stim_s': 2, 'ttest_post_stim_s': 4}
+    startframe = int(np.ceil((params['pre_stim_s']-params['ttest_pre_stim_s'])*fRate))
+    endframe = int(np.ceil((params['pre_stim_s']+params['ttest_post_stim_s'])*fRate))
+    ttest_pre = int(np.ceil(params['ttest_pre_stim_s'])*fRate)
+    windows = {'pre_window': range(startframe, startframe+ttest_pre), 'post_window': range(startframe+ttest_pre, endframe),
+               'baseline_window': range(startframe, startframe+int(np.ceil(params['ttest_pre_stim_s']*fRate)))}
+
+    results = []
+    for n_cells, n_trials in sizes:
+        # a third of the cells respond after the stimulus
+        response = (rng.random((n_cells, 1, 1)) < 1/3) * (np.arange(n_frames) >= params['pre_stim_s']*fRate)[None, :, None]
+        dffTrace_aligned = {tType: rng.standard_normal((n_cells, n_frames, n_trials)) + 0.5*response for tType in trialTypes}
+        print('Synthetic session: ' + str(n_cells) + ' cells x ' + str(n_trials) + ' trials x ' + str(len(trialTypes)) + ' trial types')
+
+        methods = {'loop (legacy)': lambda: test_responsive_acrossTrialTypes_loop(dffTrace_aligned, frate=fRate, normalise=True),
+                   'test_responsive_batch wilcoxon': lambda: utils.test_responsive_batch(dffTrace_aligned, tests=['wilcoxon'], **windows),
+                   'test_responsive_batch all tests': lambda: utils.test_responsive_batch(dffTrace_aligned, **windows),}
+        if n_perm > 0:
+            methods['test_responsive_batch + ' + str(n_perm) + ' permutations'] = \
+                lambda: utils.test_responsive_batch(dffTrace_aligned, n_perm=n_perm, **windows)
+        for method, fun in methods.items():
+            seconds, output = timeit_best(fun, repeats=repeats)
+            if 'legacy' in method: legacy_pvals = output[0]
+            elif method.endswith('wilcoxon'):
+                for tType in trialTypes:
+                    assert np.allclose(legacy_pvals[tType], output['wilcoxon'][tType], rtol=1e-9, equal_nan=True), \
+                        'test_responsive_batch does not match the loop p-values'
+            results.append({'n_cells': n_cells, 'n_trials': n_trials, 'method': method, 'seconds': seconds})
+            print(method + ': ' + str(np.round(seconds, 4)) + ' s')
+
+    results = pd.DataFrame(results)
+    legacy_seconds = results[results.method=='loop (legacy)'].set_index(['n_cells', 'n_trials']).seconds
+    results['speedup'] = legacy_seconds.loc[list(zip(results.n_cells, results.n_trials))].values / results.seconds
+    return results
+
+if __name__ == "__main__":
+    print(benchmark_epoching())
+    print(benchmark_responsive())
@@ -629,7 +629,6 @@ def tiff_snapshot_interval(tiff_path, framerate=15.081, block_min=10, scale_um=1
     :param: block_min = duration of each 'block' in minutes, per snapshot/mean image
     :param: scale_um  = length of scale bar in microns
     """
-    import tifffile
     tiff_path = tiff_path.replace('\\', '/')
 
     assert os.path.isfile(tiff_path) and ('.tif' in tiff_path), f'{tiff_path} does not exist or is not a .tif file'
@@ -639,21 +638,14 @@ def tiff_snapshot_interval(tiff_path, framerate=15.081, block_min=10, scale_um=1
     else: framerate = framerate #fps 
     block_length_s = int(block_min*60)
 
-    with tifffile.TiffFile(tiff_path) as tif:
-        # print(tifffile.TiffFile.asarray(tif, key=range(9000)))
-        nframes = len(tif.pages)
-        block_frames = int(np.ceil(block_length_s*framerate)) # length of each block
-        n_blocks = int(np.ceil(nframes/block_frames)) # round up to nearest int
-        print(f"Iterating through {nframes}-frames, for {n_blocks} blocks of {block_frames} frames each")
-
-        mean_images = []
-        for block_num in range(n_blocks):
-            # print(f'Reading block {block_num+1}/{n_blocks}...')
-            end = nframes if (block_num+1)*block_frames>nframes else (block_num+1)*block_frames
-            tif_block = tifffile.TiffFile.asarray(tif, key=range(block_num*block_frames,end)) #time x 1024 x 1024
-            mean_image = np.nanmean(tif_block, axis=0) 
-            mean_images.append(mean_image)
-            mean_image=None  #'scrubs' mean_image data from memory to conserve RAM?
+    # one streamed pass over the movie, mean image of each block of block_frames (instead of loading whole blocks)
+    block_frames = int(np.ceil(block_length_s*framerate)) # length of each block
+    tiff_stats = utils.tiff_stream_stats(tiff_path, block_frames=block_frames, var=False, max_proj=False, verbose=False)
+    nframes = tiff_stats['n_frames']
+    n_blocks = int(np.ceil(nframes/block_frames)) # round up to nearest int
+    print(f"Iterated through {nframes}-frames, for {n_blocks} blocks of {block_frames} frames each")
+    mean_images = list(tiff_stats['block_means'])
+    tiff_stats = None
     set_figure()
     ncol = 3
     nrows = int(np.ceil(len(mean_images)/ncol))
@@ -743,6 +735,7 @@ def plot_lickRrastersAcrossStimType (session_lick, beh_df, params, plotType = 'A
     visualStimDur =params['visualStimDur']
     stimTypes = params['stimTypes']
     color = params['plotColor']
+    session_lick = utils.RaggedTrials.from_list(session_lick) # accepts a list of arrays too
 
     if stimTypes == None:
         stimTypes = np.unique(beh_df[params['plotChannelType']])
@@ -753,8 +746,7 @@ def plot_lickRrastersAcrossStimType (session_lick, beh_df, params, plotType = 'A
     
     if plotType == 'All':
         plotID = 0
-        for i, array in enumerate(session_lick):
-            axs[plotID].plot(array, np.ones_like(array)+i, 'k.',markersize = 1)
+        axs[plotID].plot(session_lick.values, session_lick.trial_index()+1, 'k.',markersize = 1)
 
         ymax = len(session_lick)
         tickRange = max(round(ymax / 4 / 10) * 10, 10)
@@ -771,11 +763,8 @@ def plot_lickRrastersAcrossStimType (session_lick, beh_df, params, plotType = 'A
 
         # Lick density plot
         num_bins = range(0, int(np.ceil(totalLength*fRate)), int(fRate/bin_width))
-        animal_hist = np.zeros(len(num_bins)-1)
-        for i, array in enumerate(session_lick):
-            hist, bins = np.histogram(array, bins=num_bins, range=(0, totalLength*fRate))
-            animal_hist = animal_hist + hist
-        animal_hist = animal_hist / (i+1) / bin_width
+        animal_hist, bins = np.histogram(session_lick.values, bins=num_bins) # summed across trials
+        animal_hist = animal_hist / len(session_lick) / bin_width
         ax2.plot(bins[1:], animal_hist, 'k', linewidth=2, alpha=0.5)
 
         # Set y-label for the secondary y-axis
@@ -792,9 +781,8 @@ def plot_lickRrastersAcrossStimType (session_lick, beh_df, params, plotType = 'A
 
         for stimType in stimTypes:
             selectedTrials = np.where(beh_df[params['plotChannelType']] == stimType)[0]
-            session_lickSelected = [session_lick[i] for i in selectedTrials]
-            for i, array in enumerate(session_lickSelected):
-                axs[plotID].plot(array, np.ones_like(array)+i, 'k.',markersize = 1)
+            session_lickSelected = session_lick[selectedTrials]
+            axs[plotID].plot(session_lickSelected.values, session_lickSelected.trial_index()+1, 'k.',markersize = 1)
             
             ymax = len(session_lickSelected)
             tickRange = max(round(ymax / 4 / 10) * 10, 10)
@@ -810,12 +798,8 @@ def plot_lickRrastersAcrossStimType (session_lick, beh_df, params, plotType = 'A
 
             # Lick density plot
             num_bins = range(0, totalLength*fRate, int(fRate/bin_width))
-            animal_hist = np.zeros(len(num_bins)-1)
-            for i, array in enumerate(session_lickSelected):
-                hist, bins = np.histogram(array, bins=num_bins, range=(0, totalLength*fRate))
-                animal_hist = animal_hist + hist
-
-            animal_hist = animal_hist / (i+1) / bin_width
+            animal_hist, bins = np.histogram(session_lickSelected.values, bins=num_bins) # summed across trials
+            animal_hist = animal_hist / len(session_lickSelected) / bin_width
             ax2.plot(bins[1:], animal_hist,  color = color[plotID], linewidth=2, alpha=0.5)
 
             # Set y-label for the secondary y-axis
@@ -834,14 +818,12 @@ def plot_lickRrastersAcrossStimType (session_lick, beh_df, params, plotType = 'A
         for ind, stimType in enumerate(stimTypes):
             selectedTrials = np.where(beh_df[params['plotChannelType']] == stimType)[0]
             if len(selectedTrials)>0:
-                animal_lickSelected = [session_lick[i] for i in selectedTrials]
+                animal_lickSelected = session_lick[selectedTrials]
                 num_bins = range(0, totalLength*fRate, int(fRate/bin_width))
-                animal_hist = [] # np.zeros(len(num_bins)-1)
-                for i, array in enumerate(animal_lickSelected):
-                    hist, bins = np.histogram(array, bins=num_bins, range=(0, totalLength*fRate))
-                    animal_hist.append( hist) # Lets take mean here, not sum! animal_hist = animal_hist + hist
+                bins = np.array(num_bins, dtype=float)
+                animal_hist = animal_lickSelected.histogram(num_bins) # trial x bin
             
-                animal_hist = np.nanmean(np.array(animal_hist), axis=0) #/ len(animal_lickSelected) / bin_width
+                animal_hist = np.nanmean(animal_hist, axis=0) # Lets take mean here, not sum! #/ len(animal_lickSelected) / bin_width
                 sem_hist = np.nanstd(np.array(animal_hist), axis=0) / np.sqrt(len(animal_lickSelected))
                 upper_bound = animal_hist + sem_hist
                 lower_bound = animal_hist - sem_hist
@@ -919,7 +901,8 @@ def generate_lickDensity(recordingList, params, plotType = 'Truncated',
                 beh_df['firstLickTime'] = utils.get_first_lick(beh_df, params['stChanName_lick'], params['fRate_beh'])
                 trialStartTimes = (beh_df['firstLickTime'] - params['preRewardTime']) * fRate
 
-            _, session_lick = utils.lick_binner(paqData, trialStartTimes,params['stChanName_lick'], stimulation = False)
+            _, session_lick = utils.lick_binner(paqData, trialStartTimes,params['stChanName_lick'], stimulation = False, 
+                                                return_ragged=True)
             sessionBehData.append(beh_df)
             sessionLicks.append(session_lick)
             sessionNames.append(recordingList.blockName[ind])
@@ -939,12 +922,12 @@ def generate_lickDensity(recordingList, params, plotType = 'Truncated',
     elif plotType =='Truncated':
         # truncated all trials in the recordinglist
         for ind, sessionName in enumerate(sessionNames):
-            if ind==1:
+            if ind==0:
                 session_lick = sessionLicks[ind]
                 beh_df = sessionBehData[ind]
             else:
                 beh_df = pd.concat([beh_df, sessionBehData[ind]], ignore_index=True) 
-                session_lick = session_lick + sessionLicks[ind]
+                session_lick = session_lick + sessionLicks[ind] # RaggedTrials, concatenates trials
                     
         if params['funType'] == 'AcrossSessions':
             stimType = params['stimTypes'][0]
@@ -1012,17 +995,21 @@ def generate_imagingTraces(recordingList, params, plotType = 'Truncated',
             image_df = pd.read_pickle (recordingList['imagingFileName'][ind])
             # Get the stim start times 
             if params['alignmentType'] == 'StimulusAligned':
-                trialStartTimes = (beh_df['stimulusOnsetTime'] - params['preRewardTime']) * fRate 
+                eventTimes = beh_df['stimulusOnsetTime']
             elif params['alignmentType'] == 'RewardAligned':
-                trialStartTimes = (beh_df['rewardTime'] - params['preRewardTime']) * fRate
+                eventTimes = beh_df['rewardTime']
             elif params['alignmentType'] == 'LickAligned':
                 beh_df['firstLickTime'] = utils.get_first_lick(beh_df, params['stChanName_lick'], params['fRate_beh'])
-                trialStartTimes = (beh_df['firstLickTime'] - params['preRewardTime']) * fRate
-            # Calculate the mean traces for each trials x cells
-            preFrames = int(params['preRewardTime']*fRate)
-            postFrames = int(params['postRewardTime']*fRate)
+                eventTimes = beh_df['firstLickTime']
+            if 'trialOffsets' in beh_df.columns: # same reference as flu_preprocess_splitter
+                eventTimes = eventTimes + beh_df['trialOffsets']
+            # Convert event times into imaging frames, window is in imaging frames
             imaging_frames = image_df['frame-clock']
-            session_flu = utils.flu_splitter(image_df, trialStartTimes, preFrames,postFrames )
+            trialStartFrames, _ = utils.align_events_to_frames(imaging_frames, eventTimes, fs=fRate)
+            preFrames = int(np.ceil(params['preRewardTime']*fRate_imaging))
+            postFrames = int(np.ceil(params['postRewardTime']*fRate_imaging))
+            # cells x time x trials, trials outside of the imaging are NaN
+            session_flu = utils.epoch_trials(image_df['flu'], trialStartFrames, preFrames, postFrames)
             sessionBehData.append(beh_df)
             sessionFlus.append(session_flu)
             sessionNames.append(recordingList.blockName[ind])
@@ -1045,12 +1032,12 @@ def generate_imagingTraces(recordingList, params, plotType = 'Truncated',
     elif plotType =='Truncated':
         # truncated all trials in the recordinglist
         for ind, sessionName in enumerate(sessionNames):
-            if ind==1:
+            if ind==0:
                 session_flu = sessionFlus[ind]
                 beh_df = sessionBehData[ind]
             else:
                 beh_df = pd.concat([beh_df, sessionBehData[ind]], ignore_index=True) 
-                session_flu = pd.concat([session_flu, sessionFlus[ind]], ignore_index=True) 
+                session_flu = np.concatenate([session_flu, sessionFlus[ind]], axis=2) # along trials
 
                     
         if params['funType'] == 'AcrossSessions':
@@ -1120,13 +1107,12 @@ def plotSessionLickRaster_histLine(ax_stimType, ax_combined, color_chosen, param
     bin_width = params['bin_width']
     totalLength = params['totalLength']
 
+    licks = utils.RaggedTrials.from_list(licks) # accepts a list of arrays too
+
     num_bins = range(0, totalLength * fRate, int(fRate / bin_width))
-    animal_hist = np.zeros(len(num_bins) - 1)
-    
-    for i, array in enumerate(licks): #rewarded = dark purple
-        hist, bins = np.histogram(array, bins=num_bins, range=(0, totalLength * fRate))
-        animal_hist = animal_hist + (hist   * bin_width) #animal_hist = animal_hist + hist
-    animal_hist = animal_hist / (i + 1) #/ bin_width
+    hist, bins = np.histogram(licks.values, bins=num_bins) # summed across trials
+    animal_hist = hist * bin_width #animal_hist = animal_hist + hist
+    animal_hist = animal_hist / len(licks) #/ bin_width
     # print(animal_hist)
     if ax_stimType is not None:
         ax_stimType.plot(bins[1:], animal_hist, color=color_chosen, linestyle=ls, linewidth=2, alpha=alpha)
@@ -1135,9 +1121,9 @@ def plotSessionLickRaster_histLine(ax_stimType, ax_combined, color_chosen, param
     return ax_stimType, ax_combined
 
 def plotSessionLickRaster_rasterdots(ax, licks, color='k', marker='.', markersize=1, alpha=.8):
-    for i, licks_in_trial in enumerate(licks):
-        ax.plot(licks_in_trial, np.ones_like(licks_in_trial) + i, color=color, marker=marker, linestyle='none',
-                markersize=markersize, alpha=alpha)
+    licks = utils.RaggedTrials.from_list(licks) # accepts a list of arrays too
+    ax.plot(licks.values, licks.trial_index() + 1, color=color, marker=marker, linestyle='none',
+            markersize=markersize, alpha=alpha)
     # print(len(licks_plot))
     ymax = len(licks) + 1
     ax.set_ylim(0, ymax)
@@ -1204,7 +1190,8 @@ def plotSessionLickRaster_subplots(animalSessions, ind, params, subplotTypes=[],
             print(f'WARNING: CHECK FRAME RATES - {int(sample_rate)} in lick file, but {int(fRate)} in params. Changing fRate to {int(sample_rate)}')
     
     _, animal_lick = utils.preprocessLicks(paqData, beh_df, 'stimulusOnsetTime', stChanName='lick', lickInterval=lickInterval,
-                                           preStimTime=preRewardTime, fRate=fRate, rig=animalSessions['rig'][ind])
+                                           preStimTime=preRewardTime, fRate=fRate, rig=animalSessions['rig'][ind], 
+                                           return_ragged=True)
 
     ############# Set up the figure: set up smaller subplots within the axs object given
     num_rows = len(subplotTypes)
@@ -1216,7 +1203,7 @@ def plotSessionLickRaster_subplots(animalSessions, ind, params, subplotTypes=[],
         stimType = subplotType.split('_')[0]
         color_stimType = params['plotColor'][np.where([stimType.startswith(i) for i in params['stimType_forColor']])[0][0]] if stimType!='all' else 'k'
         stimType_indices = [int(i) for i, trial in enumerate(beh_df[plotChanelType]) if trial==stimType] if stimType!='all' else np.arange(len(beh_df[plotChanelType]))
-        licks_plot = [animal_lick[i] for i in stimType_indices] if stimType!='all' else animal_lick
+        licks_plot = animal_lick[stimType_indices] if stimType!='all' else animal_lick
         
         if 'raster' in subplotType:
             color=color_stimType  if params['colorbystimtype'] else 'k'
@@ -1229,7 +1216,7 @@ def plotSessionLickRaster_subplots(animalSessions, ind, params, subplotTypes=[],
                 for tempStimType in tempStimTypes_all:
                     tempColor = params['plotColor'][np.where([tempStimType.startswith(i) for i in params['stimType_forColor']])[0][0]] 
                     temp_indices = [i for i, trial in enumerate(beh_df[plotChanelType]) if trial==tempStimType]
-                    temp_licks = [animal_lick[i] for i in temp_indices]
+                    temp_licks = animal_lick[temp_indices]
                     ax, _ = plotSessionLickRaster_histLine(ax, None, tempColor, params, temp_licks, ls='-', alpha=0.5)
             else: ax, _ = plotSessionLickRaster_histLine(ax, None, color_stimType, params, licks_plot, ls='-', alpha=0.5)
             ax.set_ylabel('Mean lick rate (Hz)')
@@ -1310,7 +1297,8 @@ def plotSessionLickRaster(animalSessions, ind, params, savePath = None, showPlot
             print(f'WARNING: CHECK FRAME RATES - {int(sample_rate)} in lick file, but {int(fRate)} in params.')
     
     _, animal_lick = utils.preprocessLicks(paqData, beh_df, 'stimulusOnsetTime', stChanName='lick', lickInterval=lickInterval,
-                                           preStimTime=preRewardTime, fRate=fRate, rig=animalSessions['rig'][ind])
+                                           preStimTime=preRewardTime, fRate=fRate, rig=animalSessions['rig'][ind], 
+                                           return_ragged=True)
     # _, animal_lick = utils.lick_binner(paqData, trialStartTimes, stChanName_lick, 
     #                                    threshold=params['threshold_lick'], distance=lickInterval)
     if 'rig' in animalSessions.columns:
@@ -1373,28 +1361,31 @@ def plotSessionLickRaster(animalSessions, ind, params, savePath = None, showPlot
         indTrunc=len(beh_df)+1 #no trials will be found to be <indTrunc
     else:
         print('Trial index for truncation set to', indTrunc)
-    for i, array in enumerate(animal_lick):
-        for idx, stimType in enumerate(stimTypes):
-            if beh_df[plotChanelType][i] == stimTypes[idx]:
-                try: 
-                    color_ind = np.where([stimType.startswith(i) for i in params['stimType_forColor']])[0][0]
-                    color_plot = color[color_ind]
-                except:
-                    color_plot = 'grey'
-                # Original all trials
-                axs[0].plot(array, np.ones_like(array) + i, color=color_plot, marker='.', linestyle='none',
-                            markersize=1)
-                #Truncated (indTrunc) and cleaned of aberrant trials (trialsSkip)
-                if ncol==2:
-                    if (i not in trialsSkip and i<indTrunc):
-                        axs[1].plot(array, np.ones_like(array) + i, color=color_plot, marker='.', linestyle='none',
-                                    markersize=1)
-                    
-                    cleaned_trialsN = len([i for i in range(len(animal_lick)) if (i not in trialsSkip and i<indTrunc)])
-                    axs[0].set_title(f'Original, {ymax} trials')
-                    axs[1].set_title(f'{cleaned_trialsN} trials after processing')
-                else:
-                    axs[0].set_title('Raster licking plot for all trials in order of occurrence')
+    for idx, stimType in enumerate(stimTypes):
+        trials_stimType = np.where(beh_df[plotChanelType] == stimTypes[idx])[0]
+        if len(trials_stimType) == 0:
+            continue
+        try: 
+            color_ind = np.where([stimType.startswith(i) for i in params['stimType_forColor']])[0][0]
+            color_plot = color[color_ind]
+        except:
+            color_plot = 'grey'
+        # Original all trials
+        licks_stimType = animal_lick[trials_stimType]
+        axs[0].plot(licks_stimType.values, trials_stimType[licks_stimType.trial_index()] + 1, color=color_plot, marker='.', 
+                    linestyle='none', markersize=1)
+        #Truncated (indTrunc) and cleaned of aberrant trials (trialsSkip)
+        if ncol==2:
+            trials_cleaned = np.array([i for i in trials_stimType if (i not in trialsSkip and i<indTrunc)], dtype=int)
+            licks_cleaned = animal_lick[trials_cleaned]
+            axs[1].plot(licks_cleaned.values, trials_cleaned[licks_cleaned.trial_index()] + 1, color=color_plot, marker='.', 
+                        linestyle='none', markersize=1)
+            
+            cleaned_trialsN = len([i for i in range(len(animal_lick)) if (i not in trialsSkip and i<indTrunc)])
+            axs[0].set_title(f'Original, {ymax} trials')
+            axs[1].set_title(f'{cleaned_trialsN} trials after processing')
+        else:
+            axs[0].set_title('Raster licking plot for all trials in order of occurrence')
 
     # ymax = len(animal_lick)
     for i in range(ncol):
@@ -1425,23 +1416,23 @@ def plotSessionLickRaster(animalSessions, ind, params, savePath = None, showPlot
         selectedTrials = np.where(beh_df[plotChanelType] == stimType)[0]
         for colIdx in range(ncol):
             if colIdx==0:
-                animal_lickSelected = [animal_lick[i] for i in selectedTrials]
+                animal_lickSelected = animal_lick[selectedTrials]
                 reward_volSelected = [beh_df['rewardVolume'][i] for i in selectedTrials]
                 plotID = rowNum * ncol
                 last_plotID = (nrows_argin-1) * ncol
             elif colIdx==1: #colIdx can only be 1 if trialsSkip or indTrunc are not None
-                animal_lickSelected = [animal_lick[i] for i in selectedTrials if (i not in trialsSkip and i<indTrunc)]
+                animal_lickSelected = animal_lick[np.array([i for i in selectedTrials if (i not in trialsSkip and i<indTrunc)], dtype=int)]
                 reward_volSelected = [beh_df['rewardVolume'][i] for i in selectedTrials if (i not in trialsSkip and i<indTrunc)]
                 plotID = rowNum * ncol + 1
                 last_plotID = (nrows_argin-1) * ncol + 1
             reward_volSelected = np.array(reward_volSelected)
 
             # Plot lick raster dots
-            for i, array in enumerate(animal_lickSelected):
-                if reward_volSelected[i] == 0:  #plot as grey dots for unrewarded
-                    axs[plotID].plot(array, np.ones_like(array) + i, marker = '.', markersize=1, color = 'grey', linestyle = 'none')
-                elif reward_volSelected[i] > 0: #plot as baby pink dots for rewarded #or blue?
-                    axs[plotID].plot(array, np.ones_like(array) + i, marker = '.', markersize=1, color = '#f4c2c2', linestyle = 'none') 
+            trial_idx = animal_lickSelected.trial_index()
+            isUnrewarded = reward_volSelected[trial_idx] == 0 #plot as grey dots for unrewarded
+            isRewarded = reward_volSelected[trial_idx] > 0 #plot as baby pink dots for rewarded #or blue?
+            axs[plotID].plot(animal_lickSelected.values[isUnrewarded], trial_idx[isUnrewarded] + 1, marker = '.', markersize=1, color = 'grey', linestyle = 'none')
+            axs[plotID].plot(animal_lickSelected.values[isRewarded], trial_idx[isRewarded] + 1, marker = '.', markersize=1, color = '#f4c2c2', linestyle = 'none') 
                 
             ymax = len(animal_lickSelected) #number of trials
             if colIdx==0:
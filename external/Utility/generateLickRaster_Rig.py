@@ -7,6 +7,7 @@
 ############################################################################
 #######  IMPORT LIBRARIES & DEFINE FUNCTIONS #####
 import numpy as np
+import os
 import matplotlib.pyplot as plt
 from datetime import datetime
 import easygui
@@ -49,45 +50,43 @@ def paq_read(file_path=None, plot=False, save_path=None):
     # open file
     fid = open(file_path, 'rb')
     print('Reading file: ' + file_path)
-    # get sample rate
-    rate = int(np.fromfile(fid, dtype='>f', count=1))
-    # get number of channels
-    num_chans = int(np.fromfile(fid, dtype='>f', count=1))
-    # get channel names
-    chan_names = []
-    for i in range(num_chans):
-        num_chars = int(np.fromfile(fid, dtype='>f', count=1))
-        chan_name = ''
-        for j in range(num_chars):
-            chan_name = chan_name + chr(int(np.fromfile(fid, dtype='>f', count=1)))
-        chan_names.append(chan_name)
-
-    # get channel hardware lines
-    hw_chans = []
-    for i in range(num_chans):
-        num_chars = int(np.fromfile(fid, dtype='>f', count=1))
-        hw_chan = ''
-        for j in range(num_chars):
-            hw_chan = hw_chan + chr(int(np.fromfile(fid, dtype='>f', count=1)))
-        hw_chans.append(hw_chan)
-
-    # get acquisition units
-    units = []
-    for i in range(num_chans):
-        num_chars = int(np.fromfile(fid, dtype='>f', count=1))
-        unit = ''
-        for j in range(num_chars):
-            unit = unit + chr(int(np.fromfile(fid, dtype='>f', count=1)))
-        units.append(unit)
-
-    # get data
-    temp_data = np.fromfile(fid, dtype='>f', count=-1)
-    num_datapoints = int(len(temp_data)/num_chans)
-    data = np.reshape(temp_data, [num_datapoints, num_chans]).transpose()
+    # read the header in one go (every value is a big-endian float32),
+    # enlarging the read if the channel names do not fit
+    n_read = 4096
+    while True:
+        fid.seek(0)
+        header = np.fromfile(fid, dtype='>f', count=n_read)
+        try:
+            # get sample rate and number of channels
+            rate = int(header[0])
+            num_chans = int(header[1])
+            # get channel names, channel hardware lines and acquisition units
+            pos = 2
+            strings = []
+            for i in range(3*num_chans):
+                num_chars = int(header[pos])
+                if pos+1+num_chars > len(header):
+                    raise IndexError
+                strings.append(''.join(chr(int(c)) for c in header[pos+1:pos+1+num_chars]))
+                pos = pos+1+num_chars
+            break
+        except IndexError:
+            if len(header) < n_read:
+                raise ValueError('Header of ' + file_path + ' is truncated, is this a .paq file?')
+            n_read = n_read*4
+    chan_names = strings[:num_chans]
+    hw_chans = strings[num_chans:2*num_chans]
+    units = strings[2*num_chans:]
 
     # close file
     fid.close()
 
+    # get data: memory-map the interleaved body and view it as channels x datapoints,
+    # values are only read (and decoded from big-endian) when a channel is indexed
+    num_datapoints = int((os.path.getsize(file_path)//4 - pos)/num_chans)
+    data = np.memmap(file_path, dtype='>f', mode='r', offset=pos*4,
+                     shape=(num_datapoints, num_chans)).transpose()
+
     # plot
     if plot:
         f, axes = plt.subplots(num_chans, 1, sharex=True)
@@ -112,7 +111,7 @@ def paq_data(paq, chan_name, threshold, threshold_ttl = False, plot=False):
     if threshold_tll: returns sample that trigger occured on
     '''
     chan_idx = paq['chan_names'].index(chan_name)
-    data = paq['data'][chan_idx, :]
+    data = np.asarray(paq['data'][chan_idx, :], dtype=np.float32) # decode only this channel
     if threshold_ttl == False:
         data = data
     elif threshold_ttl == 'Mix':
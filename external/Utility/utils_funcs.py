@@ -20,6 +20,8 @@ from scipy.io import loadmat
 import glob
 import tifffile
 import re
+import hashlib
+import shutil
 from scipy.signal import find_peaks, detrend, savgol_filter
 from time import time
 import string
@@ -210,22 +212,19 @@ def extract_paq_data_frame(paq_filepath, rewardChanelName, twoPChannelName = '2p
         paq = pd.read_pickle(filenamePAQ)
     threshold_volts = 2.5
 
-    # Extract reward frame numbers
-    idx_reward = paq["chan_names"].index(rewardChanelName)
-    frame_count_reward = np.flatnonzero((paq["data"][idx_reward][:-1] < threshold_volts) & (paq["data"][idx_reward][1:] > threshold_volts))+1
+    # Extract reward and imaging frame numbers in a single pass through the recording
+    channels = {rewardChanelName: {'threshold': threshold_volts}}
+    if twoPChannelName is not None:
+        channels[twoPChannelName] = {'threshold': threshold_volts}
+    frame_counts = stream_ttl_edges(paq, channels)
+
+    frame_count_reward = frame_counts[rewardChanelName]
     reward_frame_filename = paq_filepath.replace('.paq','_reward_frames.txt')
-    with open(reward_frame_filename, "w") as f:
-        f.write('\n'.join(str(f) for f in frame_count_reward))
-    #print("Saved file:", reward_frame_filename)
+    save_frame_count(frame_count_reward, reward_frame_filename, verbose=False)
 
-    # Extract imaging frame numbers
     if twoPChannelName is not None:
-        idx_reward = paq["chan_names"].index(twoPChannelName)
-        frame_count_imaging = np.flatnonzero((paq["data"][idx_reward][:-1] < threshold_volts) & (paq["data"][idx_reward][1:] > threshold_volts))+1
-        reward_frame_filename = paq_filepath.replace('.paq','_imaging_frames.txt')
-        with open(reward_frame_filename, "w") as f:
-            f.write('\n'.join(str(f) for f in frame_count_imaging))
-        #print("Saved file:", reward_frame_filename)
+        imaging_frame_filename = paq_filepath.replace('.paq','_imaging_frames.txt')
+        save_frame_count(frame_counts[twoPChannelName], imaging_frame_filename, verbose=False)
     else:
         print('No imaging frame for this session.')
 
@@ -247,25 +246,22 @@ def extract_paqPkl_data_frame(paqpkl_filepath, paq_filepath, rewardChanelName, t
     paq = pd.read_pickle(paqpkl_filepath)
     threshold_volts = 2.5
 
-    # Extract reward frame numbers
-    idx_reward = paq["chan_names"].index(rewardChanelName)
-    frame_count_reward = np.flatnonzero((paq["data"][idx_reward][:-1] < threshold_volts) & (paq["data"][idx_reward][1:] > threshold_volts))+1
+    # Extract reward and imaging frame numbers in a single pass through the recording
+    channels = {rewardChanelName: {'threshold': threshold_volts}}
+    if twoPChannelName is not None:
+        channels[twoPChannelName] = {'threshold': threshold_volts}
+    frame_counts = stream_ttl_edges(paq, channels)
+
+    frame_count_reward = frame_counts[rewardChanelName]
     if paq_filepath.endswith('.paq'):
         reward_frame_filename = paq_filepath.replace('.paq','_reward_frames.txt')
     elif paq_filepath.endswith('.mat'):
         reward_frame_filename = paq_filepath.replace('.mat','_reward_frames.txt')
-    with open(reward_frame_filename, "w") as f:
-        f.write('\n'.join(str(f) for f in frame_count_reward))
-    print("Saved file:", reward_frame_filename)
+    save_frame_count(frame_count_reward, reward_frame_filename)
 
-    # Extract imaging frame numbers
     if twoPChannelName is not None:
-        idx_reward = paq["chan_names"].index(twoPChannelName)
-        frame_count_imaging = np.flatnonzero((paq["data"][idx_reward][:-1] < threshold_volts) & (paq["data"][idx_reward][1:] > threshold_volts))+1
-        reward_frame_filename = paq_filepath.replace('.paq','_imaging_frames.txt').replace('.mat','_imaging_frames.txt')
-        with open(reward_frame_filename, "w") as f:
-            f.write('\n'.join(str(f) for f in frame_count_imaging))
-        print("Saved file:", reward_frame_filename)
+        imaging_frame_filename = paq_filepath.replace('.paq','_imaging_frames.txt').replace('.mat','_imaging_frames.txt')
+        save_frame_count(frame_counts[twoPChannelName], imaging_frame_filename)
     else:
         print('No imaging frame for this session.')
 
@@ -283,19 +279,16 @@ def extract_frames_from_timeline(timeline_filepath, rewardChannel = 'reward_echo
     """
     timeline = timeline_mat_load(timeline_filepath)
 
-    # Extract reward frame numbers, in DAQ frames
-    frame_count_reward = paq_data(timeline, rewardChannel,threshold=reward_threshold,threshold_ttl=True, plot=False) 
+    # Extract reward and imaging frame numbers, in DAQ frames (thresholded as in paq_data(threshold_ttl=True))
+    frame_counts = stream_ttl_edges(timeline, {rewardChannel: {'threshold': reward_threshold, 'crossing': False},
+                                               imagingChannel: {'threshold': imaging_threshold, 'crossing': False}})
+    frame_count_reward = frame_counts[rewardChannel]
     reward_frame_filename = timeline_filepath.replace('.mat','_reward_frames.txt')
-    with open(reward_frame_filename, "w") as f:
-        f.write('\n'.join(str(f) for f in frame_count_reward))
-    print("Saved file:", reward_frame_filename)
+    save_frame_count(frame_count_reward, reward_frame_filename)
 
-    # Extract imaging frame numbers, in DAQ frames
-    frame_count_imaging = paq_data(timeline, imagingChannel,threshold=imaging_threshold,threshold_ttl=True, plot=False) 
+    frame_count_imaging = frame_counts[imagingChannel]
     imaging_frame_filename = timeline_filepath.replace('.mat','_imaging_frames.txt')
-    with open(imaging_frame_filename, "w") as f:
-        f.write('\n'.join(str(f) for f in frame_count_imaging))
-    print("Saved file:", imaging_frame_filename)
+    save_frame_count(frame_count_imaging, imaging_frame_filename)
 
     return frame_count_reward, frame_count_imaging
 
@@ -314,12 +307,9 @@ def extract_daqPkl_data_frame(daqpkl_filepath, daq_filepath, rewardChanelName):
     threshold_volts = 2.5
 
     # Extract reward frame numbers
-    idx_reward = paq["chan_names"].index(rewardChanelName)
-    frame_count_reward = np.flatnonzero((paq["data"][idx_reward][:-1] < threshold_volts) & (paq["data"][idx_reward][1:] > threshold_volts))+1
+    frame_count_reward = stream_ttl_edges(paq, {rewardChanelName: {'threshold': threshold_volts}})[rewardChanelName]
     reward_frame_filename = daq_filepath.replace('.mat','_reward_frames.txt')
-    with open(reward_frame_filename, "w") as f:
-        f.write('\n'.join(str(f) for f in frame_count_reward))
-    print("Saved file:", reward_frame_filename)
+    save_frame_count(frame_count_reward, reward_frame_filename)
 
     if __name__ == "__main__":
         for file in glob.glob("*.paq"): 
@@ -341,12 +331,9 @@ def extract_daqPkl2_data_frame(daqpkl_filepath, daq_filepath, rewardChanelName):
 
     daq_filepath = os.path.join(daq_filepath, daq_filepath.split('/')[-1]+'.mat') 
     # Extract reward frame numbers
-    idx_reward = paq["chan_names"].index(rewardChanelName)
-    frame_count_reward = np.flatnonzero((paq["data"][idx_reward][:-1] < threshold_volts) & (paq["data"][idx_reward][1:] > threshold_volts))+1
+    frame_count_reward = stream_ttl_edges(paq, {rewardChanelName: {'threshold': threshold_volts}})[rewardChanelName]
     reward_frame_filename = daq_filepath.replace('.mat','_reward_frames.txt')
-    with open(reward_frame_filename, "w") as f:
-        f.write('\n'.join(str(f) for f in frame_count_reward))
-    print("Saved file:", reward_frame_filename)
+    save_frame_count(frame_count_reward, reward_frame_filename)
 
     if __name__ == "__main__":
         for file in glob.glob("*.paq"): 
@@ -355,6 +342,104 @@ def extract_daqPkl2_data_frame(daqpkl_filepath, daq_filepath, rewardChanelName):
 
     return paq, frame_count_reward
 
+def stream_ttl_edges(recording, channels=None, chunk_samples=2**20):
+    """ Return the RISE TIME (sample index) of every TTL pulse in each of the requested channels,
+    reading the recording once in blocks of chunk_samples. The state at the end of each block is carried
+    into the next, so the result is the same as thresholding each whole channel at once.
+
+    :param: recording     - paq/daq dictionary (from paq_read, timeline_mat_load or a paq-data.pkl) or
+                            path to a .paq, .pkl or .mat (Timeline) file. A .paq file is memory-mapped, so
+                            only one block per channel is ever held in memory.
+    :param: channels      - list of channel names (default thresholds), or dictionary of {chan_name: edge params}
+                            where edge params can be:
+                            'threshold' (default 2.5): voltage threshold
+                            'crossing'  (default True): True counts a sample above threshold immediately after a sample
+                                        below it (as in extract_paq_data_frame); False follows threshold_detect, i.e.
+                                        the first sample above threshold (and below cutoff), including the first sample
+                            'cutoff'    (default False): upper voltage limit, as in threshold_detect
+                            'distance'  (default False): minimum distance between edges, applied with select_by_peak_distance
+                            None returns edges for every channel in recording['chan_names']
+    :param: chunk_samples - number of samples per block
+
+    :output: frame_counts - dictionary of {chan_name: array of rising-edge sample indices}
+    """
+    if isinstance(recording, str):
+        if recording.endswith('.paq'):
+            recording = paq_read(recording, plot=False)
+        elif recording.endswith('.mat'):
+            recording = timeline_mat_load(recording)
+        else:
+            recording = pd.read_pickle(recording)
+
+    if channels is None:
+        channels = list(recording['chan_names'])
+    if not isinstance(channels, dict):
+        channels = {chan: {} for chan in channels}
+    default_edge = {'threshold': 2.5, 'crossing': True, 'cutoff': False, 'distance': False}
+    channels = {chan: {**default_edge, **edge} for chan, edge in channels.items()}
+
+    data = recording['data']
+    chan_idxs = {chan: list(recording['chan_names']).index(chan) for chan in channels}
+    if getattr(data, 'ndim', 1) > 1:
+        n_samples = data.shape[1]
+        get_block = lambda idx, start, stop: data[idx, start:stop]
+    else: # data stored as a list of one-dimensional arrays
+        n_samples = max(len(data[idx]) for idx in chan_idxs.values())
+        get_block = lambda idx, start, stop: data[idx][start:stop]
+
+    prev_sample = {chan: False for chan in channels} # is the last sample of the previous block below threshold ('crossing') or not counted as above ('threshold_detect')
+    edges = {chan: [] for chan in channels}
+    edge_values = {chan: [] for chan in channels}
+    for start in range(0, n_samples, chunk_samples):
+        stop = min(start+chunk_samples, n_samples)
+        for chan, edge in channels.items():
+            block = np.asarray(get_block(chan_idxs[chan], start, stop))
+            if len(block) == 0:
+                continue
+            above = block > edge['threshold']
+            if edge['cutoff']:
+                above = above & (block < edge['cutoff'])
+            if edge['crossing']:
+                below = block < edge['threshold']
+                is_edge = above & np.concatenate(([prev_sample[chan]], below[:-1]))
+                prev_sample[chan] = below[-1]
+            else:
+                is_edge = above & ~np.concatenate(([prev_sample[chan]], above[:-1]))
+                prev_sample[chan] = above[-1]
+            block_edges = np.flatnonzero(is_edge)
+            edges[chan].append(block_edges + start)
+            edge_values[chan].append(block[block_edges])
+
+    frame_counts = {}
+    for chan, edge in channels.items():
+        times = np.concatenate(edges[chan]) if len(edges[chan]) else np.array([], dtype=np.int64)
+        if edge['distance']: # debounce, as in threshold_detect
+            values = np.concatenate(edge_values[chan]) if len(edge_values[chan]) else np.array([])
+            keep = select_by_peak_distance(times, values, edge['distance'])
+            times = times[np.where(np.array(keep))[0]]
+        frame_counts[chan] = times
+    return frame_counts
+
+def save_frame_count(frame_count, frame_filename, verbose=True):
+    """ Save frame numbers as the legacy newline-separated .txt file (frame_filename, e.g. ..._imaging_frames.txt)
+    and as a .npy file with the same name, which is much faster to load (see load_frame_count)
+    """
+    frame_count = np.asarray(frame_count)
+    with open(frame_filename, "w") as f:
+        f.write('\n'.join(str(f) for f in frame_count))
+    np.save(os.path.splitext(frame_filename)[0] + '.npy', frame_count)
+    if verbose: print("Saved file:", frame_filename)
+
+def load_frame_count(frame_filename):
+    """ Load frame numbers saved by save_frame_count, from the .npy file if it exists and is not older than the .txt file 
+    (scripts that only write the .txt, e.g. extract_paq_events.py, leave a stale .npy behind), otherwise from the .txt file
+    """
+    npy_filename = os.path.splitext(frame_filename)[0] + '.npy'
+    if os.path.isfile(npy_filename) and \
+        (not os.path.isfile(frame_filename) or os.path.getmtime(npy_filename) >= os.path.getmtime(frame_filename)):
+        return np.load(npy_filename)
+    return pd.read_csv(frame_filename, header=None).values.ravel()
+
 def timeline_mat_load(timeline_mat_path, plot = False, save_path = None):
     """Find _Timeline.mat file and load data into a dictionary for DAQ data from black boxes"""
 
@@ -800,17 +885,119 @@ def extract_daq_data_frame(daq_dict, rewardChanelName, timeline_mat_path):
 
     threshold_volts = 2.5
 
-    idx_reward = daq_dict["chan_names"].index(rewardChanelName)
-
-    frame_count_reward = np.flatnonzero(
-        (daq_dict["data"][idx_reward][:-1] < threshold_volts) & (daq_dict["data"][idx_reward][1:] > threshold_volts)) + 1
+    frame_count_reward = stream_ttl_edges(daq_dict, {rewardChanelName: {'threshold': threshold_volts}})[rewardChanelName]
 
     if timeline_mat_path.endswith('_Timeline.mat'):
         reward_frame_filename = timeline_mat_path.replace('.mat', '_reward_frames.txt')
     
-    with open(reward_frame_filename, "w") as f:
-        f.write('\n'.join(str(f) for f in frame_count_reward))
-    print("Saved file:", reward_frame_filename)
+    save_frame_count(frame_count_reward, reward_frame_filename)
+
+def tiff_page_count(tif):
+    """ Number of pages in an open tifffile.TiffFile, read from the ImageJ or OME header when there is one 
+    (enumerating the pages of a long movie reads every IFD of the file)
+    :param: tif      = open tifffile.TiffFile
+    :output: npages  = (int) number of pages (frames x channels x planes)
+    """
+    if tif.is_imagej and tif.imagej_metadata is not None and 'images' in tif.imagej_metadata:
+        return int(tif.imagej_metadata['images'])
+    if tif.is_ome:
+        try:
+            # multi-file OME headers describe the pages of the whole dataset
+            ome_files = set(re.findall(r'FileName="([^"]+)"', tif.ome_metadata)) - {os.path.basename(tif.filehandle.path)}
+            if len(ome_files) == 0:
+                series = tif.series[0]
+                return int(np.prod([n for n, ax in zip(series.shape, series.axes) if ax not in 'YXS']))
+        except Exception as e: print(f"utils.tiff_page_count: could not read OME header ({e}), counting pages")
+    return len(tif.pages)
+
+def tiff_stream_stats(tiff_path, block_frames=None, chunk_MB=128, var=True, max_proj=True, mmap=True, 
+                      maxworkers=None, prefetch=True, verbose=True):
+    """ Mean, variance, max projection and per-block mean images of a tiff movie in one pass over chunks of pages,
+    so memory stays at ~3 x chunk_MB regardless of movie length 
+    :param: tiff_path    = path of a .tif file, every page is one frame (single channel movie)
+    :param: block_frames = (int) n frames per block for block_means (None: no block means); the last block can be shorter
+    :param: chunk_MB     = (num) size of each chunk once converted to float64 
+    :param: var          = (bool) whether to accumulate the variance (Chan et al. merge of per-chunk float64 sums of squares)
+    :param: max_proj     = (bool) whether to accumulate the max projection
+    :param: mmap         = (bool) memory-map the movie if the file is contiguous and uncompressed, otherwise pages are decoded
+    :param: maxworkers   = (int) threads used by tifffile to decode compressed pages (None: tifffile default)
+    :param: prefetch     = (bool) read the next chunk in a background thread while the current chunk is reduced
+    :output: stats       = (dict) n_frames, mean, var, max, block_means (block x y x x), block_frames, shape and dtype 
+                           (mean/var/block_means are float64 and ignore NaNs as np.nanmean; max as np.nanmax)
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    with tifffile.TiffFile(tiff_path) as tif:
+        npages = tiff_page_count(tif)
+        page = tif.pages[0]
+        frame_shape, dtype = page.shape, page.dtype
+        movie = None
+        if mmap:
+            try: 
+                movie = tifffile.memmap(tiff_path, mode='r')
+                movie = movie.reshape(-1, *frame_shape) if movie.size == npages*np.prod(frame_shape) else None
+            except ValueError: movie = None # not contiguous or compressed
+        if verbose:
+            print(f"utils.tiff_stream_stats: {npages} frames of {frame_shape} {dtype} in {os.path.basename(tiff_path)} "
+                  f"({'memory-mapped' if movie is not None else 'decoding pages'})")
+        def read_chunk(start, end):
+            if movie is not None: return np.asarray(movie[start:end])
+            return tif.asarray(key=range(start, end), maxworkers=maxworkers).reshape(-1, *frame_shape)
+
+        # chunks never straddle two blocks, so block means are the sums of whole chunks
+        chunk_frames = max(1, int(chunk_MB*1e6 // (np.prod(frame_shape)*8)))
+        block_frames = npages if block_frames is None else int(block_frames)
+        edges = np.union1d(np.arange(0, npages, chunk_frames), np.arange(0, npages, block_frames))
+        chunks = list(zip(edges, np.append(edges[1:], npages)))
+
+        is_float = np.issubdtype(dtype, np.floating)
+        count = np.zeros(frame_shape) if is_float else 0
+        mean = np.zeros(frame_shape)
+        M2 = np.zeros(frame_shape) if var else None
+        maxImg = None
+        block_sums, block_counts = [], []
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            pending = pool.submit(read_chunk, *chunks[0]) if prefetch and len(chunks) else None
+            for i, (start, end) in enumerate(chunks):
+                chunk = pending.result() if prefetch else read_chunk(start, end)
+                if prefetch and i+1 < len(chunks): pending = pool.submit(read_chunk, *chunks[i+1])
+
+                if is_float:
+                    count_c = np.sum(~np.isnan(chunk), axis=0)
+                    sum_c = np.nansum(chunk, axis=0, dtype=np.float64)
+                else: count_c, sum_c = end-start, np.sum(chunk, axis=0, dtype=np.float64)
+                if var:
+                    mean_c = np.divide(sum_c, count_c, out=np.zeros(frame_shape), where=np.asarray(count_c)>0)
+                    dev = np.subtract(chunk, mean_c) # float64 temporary of chunk_MB
+                    np.square(dev, out=dev)
+                    M2_c = np.nansum(dev, axis=0) if is_float else np.sum(dev, axis=0)
+                    dev = None
+                    count_new = count + count_c
+                    delta = mean_c - mean
+                    mean += np.divide(delta*count_c, count_new, out=np.zeros(frame_shape), where=np.asarray(count_new)>0)
+                    M2 += M2_c + np.divide(delta**2*count*count_c, count_new, out=np.zeros(frame_shape), where=np.asarray(count_new)>0)
+                    count = count_new
+                else: 
+                    mean += sum_c # running sum, divided at the end
+                    count = count + count_c
+                if max_proj:
+                    max_c = np.fmax.reduce(chunk, axis=0) if is_float else np.max(chunk, axis=0)
+                    maxImg = max_c if maxImg is None else np.fmax(maxImg, max_c)
+
+                if start % block_frames == 0:
+                    block_sums.append(np.zeros(frame_shape))
+                    block_counts.append(np.zeros(frame_shape) if is_float else 0)
+                block_sums[-1] += sum_c
+                block_counts[-1] = block_counts[-1] + count_c
+                chunk = None
+
+    with np.errstate(invalid='ignore', divide='ignore'): # pixels that are NaN in every frame stay NaN, as np.nanmean
+        if not var: mean = mean / count
+        else: mean[np.asarray(count*np.ones(frame_shape))==0] = np.nan
+        stats = {'n_frames': npages, 'mean': mean, 'var': M2 / count if var else None, 'max': maxImg,
+                 'block_means': np.stack([s/c for s, c in zip(block_sums, block_counts)]) if len(block_sums) else None,
+                 'block_frames': block_frames, 'shape': (npages, *frame_shape), 'dtype': dtype}
+    return stats
 
 def tiff_metadata(folderTIFF, ch2=True):
 
@@ -840,7 +1027,7 @@ def tiff_metadata(folderTIFF, ch2=True):
         for tag in tif.pages[0].tags.values():
             name, value = tag.name, tag.value
             tif_tags[name] = value
-        tif_npages=len(tif.pages)
+        tif_npages = tiff_page_count(tif)
 
     x_px = tif_tags['ImageWidth']
     y_px = tif_tags['ImageLength']
@@ -869,9 +1056,8 @@ def tiff_meanImg(tiff_path):
             tiff_file = tiff_list[int(choice)]
     else: tiff_file = tiff_path
     print(f"Processing {os.path.basename(tiff_file)} for utils.tiff_meanImg()")
-    with tifffile.TiffFile(tiff_file) as tif:
-        tif_array = tifffile.TiffFile.asarray(tif) #time x 1024 x 1024
-        meanImg_tif = np.nanmean(tif_array, axis=0) # 2D array of xy (or yx) pixels
+    # streamed in chunks instead of loading the whole movie (time x 1024 x 1024)
+    meanImg_tif = tiff_stream_stats(tiff_file, var=False, max_proj=False, verbose=False)['mean'] # 2D array of xy (or yx) pixels
 
     return meanImg_tif
 
@@ -920,12 +1106,13 @@ def cellmasks_from_s2pstat(stat, shape=(1024,1024), meanImg_measure=None, cells_
     else: return cell_mask_colour
 
 def calculateDFF (tiff_folderpath, frameClockfromPAQ, suite2pOutputPath=None, 
-                  dynamic=True, allROIsAreCells=False, rig=None):
+                  dynamic=True, allROIsAreCells=False, rig=None, cache=None):
     ''' ST 28/05/2024: 
         Added suite2pOutputPath if s2p_path and tiff_folderpath are different
         Added allROIsAreCells to s2p_loader, and so include argument here. By default, is False and so will 
             follow iscell.npy to distinguish traces from 'cells' and 'not cells'. 
             If True, will disregard iscell.npy and let all traces be cells
+        Added cache (NpyCache) to reuse the suite2p outputs across calls
     '''
     if suite2pOutputPath is None:
         s2p_path = tiff_folderpath +'\\suite2p\\plane0\\'
@@ -937,10 +1124,12 @@ def calculateDFF (tiff_folderpath, frameClockfromPAQ, suite2pOutputPath=None,
             s2p_path = suite2pOutputPath +'\\plane0_red\\'
             ch2=False
     ch2=True if rig=='Dual2p' else False
-    # from Vape - catcher file: 
-    flu_raw, _, _ = s2p_loader(s2p_path, subtract_neuropil=False,allROIsAreCells=allROIsAreCells) 
-
-    flu_raw_subtracted, spks, stat = s2p_loader(s2p_path, allROIsAreCells=allROIsAreCells)
+    # from Vape - catcher file: suite2p outputs are loaded once, raw and neuropil-subtracted flu as in s2p_loader
+    s2p_cells = s2p_load(s2p_path, allROIsAreCells=allROIsAreCells, cache=cache)
+    flu_raw, spks, stat = s2p_cells['all_cells'], s2p_cells['spks'], s2p_cells['stat']
+    neuropil_coeff = 0.7
+    print('subtracting neuropil with a coefficient of {}'.format(neuropil_coeff))
+    flu_raw_subtracted = flu_raw - s2p_cells['neuropil'] * neuropil_coeff
     flu = dfof2(flu_raw_subtracted)
 
     _, n_frames = tiff_metadata(tiff_folderpath, ch2=ch2)
@@ -1001,7 +1190,88 @@ def calculateDFF (tiff_folderpath, frameClockfromPAQ, suite2pOutputPath=None,
             "stat": stat,
             "flu_raw": flu_raw}
 
-def paq_read(file_path=None, plot=False, save_path=None):
+def paq_read_header(file_path, n_read=4096):
+    """ Parse the header of a PAQ file in bulk rather than one float at a time.
+    Every header value (rate, number of channels, and the length-prefixed characters of each
+    channel name, hardware line and unit) is stored as a big-endian float32, so the first n_read
+    values are read in a single call and parsed in Python; n_read is enlarged if the header is longer.
+
+    :output: header - dict with keys rate, chan_names, hw_chans, units
+    :output: offset - position of the first data value, in float32 values from the start of the file
+    """
+    with open(file_path, 'rb') as fid:
+        while True:
+            fid.seek(0)
+            values = np.fromfile(fid, dtype='>f', count=n_read)
+            try:
+                rate = int(values[0])
+                num_chans = int(values[1])
+                pos = 2
+                strings = []
+                for i in range(3*num_chans): # channel names, then hardware lines, then units
+                    num_chars = int(values[pos])
+                    if pos+1+num_chars > len(values):
+                        raise IndexError
+                    strings.append(''.join(chr(int(c)) for c in values[pos+1:pos+1+num_chars]))
+                    pos = pos+1+num_chars
+                break
+            except IndexError:
+                if len(values) < n_read:
+                    raise ValueError(f'Header of {file_path} is truncated, is this a .paq file?')
+                n_read = n_read*4
+
+    header = {"rate": rate,
+              "chan_names": strings[:num_chans],
+              "hw_chans": strings[num_chans:2*num_chans],
+              "units": strings[2*num_chans:]}
+    return header, pos
+
+class PaqMemmap():
+    def __init__(self, file_path, offset, num_chans):
+        '''
+        Lazy channels x datapoints view of the body of a PAQ file, returned as paq['data'] by paq_read.
+        The body is stored interleaved (datapoint x channel) as big-endian float32, so it is memory-mapped
+        and exposed transposed; nothing is read until it is indexed, and only the indexed values are
+        decoded into a native-endian float32 array.
+        Supports the ndarray usage of paq['data'] in this module: .shape, len(), data[chan_idx],
+        data[chan_idx, start:stop], and np.asarray(data) (which loads everything).
+        Pickling stores a plain ndarray, so pickles can be read without this class.
+        '''
+        self.file_path = file_path
+        n_values = (os.path.getsize(file_path)//4) - offset
+        num_datapoints = n_values//num_chans
+        if num_datapoints > 0:
+            self._raw = np.memmap(file_path, dtype='>f', mode='r', offset=offset*4,
+                                  shape=(num_datapoints, num_chans))
+        else:
+            self._raw = np.empty((0, num_chans), dtype='>f')
+        self.shape = (num_chans, num_datapoints)
+        self.ndim = 2
+        self.dtype = np.dtype(np.float32)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        data = np.asarray(self._raw.T[key], dtype=np.float32)
+        return data[()] if data.ndim == 0 else data
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self._raw.T, dtype=np.float32 if dtype is None else dtype)
+
+    def __reduce__(self):
+        return (np.asarray, (np.asarray(self),))
+
+    def iter_chunks(self, chan_idx, chunk_samples=2**20, start=0, stop=None):
+        '''
+        Yields (sample index of chunk start, decoded chunk) for channel chan_idx (int, or list of ints
+        for a channel x time chunk), so long recordings can be processed without decoding a whole channel
+        '''
+        stop = self.shape[1] if stop is None else min(stop, self.shape[1])
+        for chunk_start in range(start, stop, chunk_samples):
+            yield chunk_start, self[chan_idx, chunk_start:min(chunk_start+chunk_samples, stop)]
+
+def paq_read(file_path=None, plot=False, save_path=None, lazy=True):
     """
     Read PAQ file (from PackIO) into python
     Lloyd Russell 2015
@@ -1012,9 +1282,12 @@ def paq_read(file_path=None, plot=False, save_path=None):
         is opened, buggy on mac osx - Tk/matplotlib. Default: None.
     plot : bool, optional
         plot the data after reading? Default: False.
+    lazy : bool, optional
+        return data as a memory-mapped PaqMemmap, decoded per channel on access,
+        instead of loading the whole recording into memory. Default: True.
     Returns
     =======
-    data : ndarray
+    data : ndarray (or PaqMemmap if lazy)
         the data as a m-by-n array where m is the number of channels and n is
         the number of datapoints
     chan_names : list of str
@@ -1037,46 +1310,19 @@ def paq_read(file_path=None, plot=False, save_path=None):
         file_path = tkFileDialog.askopenfilename()
         root.destroy()
 
-    # open file
-    fid = open(file_path, 'rb')
-    # get sample rate
-    rate = int(np.fromfile(fid, dtype='>f', count=1))
-    # get number of channels
-    num_chans = int(np.fromfile(fid, dtype='>f', count=1))
-    # get channel names
-    chan_names = []
-    for i in range(num_chans):
-        num_chars = int(np.fromfile(fid, dtype='>f', count=1))
-        chan_name = ''
-        for j in range(num_chars):
-            chan_name = chan_name + chr(int(np.fromfile(fid, dtype='>f', count=1)))
-        chan_names.append(chan_name)
-
-    # get channel hardware lines
-    hw_chans = []
-    for i in range(num_chans):
-        num_chars = int(np.fromfile(fid, dtype='>f', count=1))
-        hw_chan = ''
-        for j in range(num_chars):
-            hw_chan = hw_chan + chr(int(np.fromfile(fid, dtype='>f', count=1)))
-        hw_chans.append(hw_chan)
-
-    # get acquisition units
-    units = []
-    for i in range(num_chans):
-        num_chars = int(np.fromfile(fid, dtype='>f', count=1))
-        unit = ''
-        for j in range(num_chars):
-            unit = unit + chr(int(np.fromfile(fid, dtype='>f', count=1)))
-        units.append(unit)
-
-    # get data
-    temp_data = np.fromfile(fid, dtype='>f', count=-1)
-    num_datapoints = int(len(temp_data)/num_chans)
-    data = np.reshape(temp_data, [num_datapoints, num_chans]).transpose()
+    # get sample rate, channel names, hardware lines and units
+    header, offset = paq_read_header(file_path)
+    rate = header['rate']
+    chan_names = header['chan_names']
+    hw_chans = header['hw_chans']
+    units = header['units']
+    num_chans = len(chan_names)
 
-    # close file
-    fid.close()
+    # get data (memory-mapped, channels x datapoints)
+    data = PaqMemmap(file_path, offset, num_chans)
+    num_datapoints = data.shape[1]
+    if not lazy:
+        data = np.asarray(data)
 
     # plot
     if plot:
@@ -1125,47 +1371,198 @@ def dfof2(flu):
     flu_mean = np.reshape(flu_mean, (len(flu_mean), 1))
     return (flu - flu_mean) / flu_mean
 
-def s2p_loader(s2p_path, subtract_neuropil=True, neuropil_coeff=0.7, allROIsAreCells=False):
-    '''28/05/2024: ST added allROIsAreCells to tell s2p_loader whether to consider all ROIs as cells or 
-                    follow iscell.npy
+class NpyCache():
+    """ Content-addressed on-disk cache of numpy arrays, e.g. for s2p_loader and flu_preprocess_splitter.
+    Entries are keyed on the fingerprints (path, size, mtime) of the source files plus the parameters used, 
+    so editing/re-running suite2p or changing parameters gives a new entry. Arrays are stored as .npy
+    and loaded memory-mapped (read-only). Least recently used entries are evicted above max_GB.
+
+    cache = NpyCache('D:\\analysis\\cache', max_GB=50)
+    imData = calculateDFF(..., cache=cache)
+    cache.report()
+    """
+    def __init__(self, cache_dir, max_GB=20, mmap=True, verbose=False):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_GB * 1e9
+        self.mmap_mode = 'r' if mmap else None
+        self.verbose = verbose
+        self.stats = {} # stage: {'hits', 'misses', 'loadTime_s', 'computeTime_s'}
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def fingerprint(paths):
+        """ (path, size, mtime) of each file, folders are expanded into the files they contain """
+        if isinstance(paths, str):
+            paths = [paths]
+        files = []
+        for path in paths:
+            if os.path.isdir(path):
+                files += sorted(walk_for_files(path))
+            else:
+                files.append(path)
+        return [[os.path.abspath(f), os.stat(f).st_size, os.stat(f).st_mtime_ns] for f in files]
+
+    def key(self, stage, source_paths, params=None):
+        content = json.dumps({'stage': stage, 'sources': self.fingerprint(source_paths), 'params': params}, 
+                             sort_keys=True, default=str)
+        return hashlib.sha1(content.encode()).hexdigest()
+
+    def _count(self, stage, outcome, seconds):
+        stage_stats = self.stats.setdefault(stage, {'hits': 0, 'misses': 0, 'loadTime_s': 0., 'computeTime_s': 0.})
+        stage_stats[outcome] += 1
+        stage_stats['loadTime_s' if outcome == 'hits' else 'computeTime_s'] += seconds
+
+    def load(self, stage, key):
+        """ Returns the dict of arrays stored under stage/key, or None if not cached """
+        entry_dir = os.path.join(self.cache_dir, stage, key)
+        meta_path = os.path.join(entry_dir, 'meta.json')
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path) as f:
+            meta = json.load(f)
+        arrays = {}
+        for name, is_object in meta['arrays'].items():
+            npy_path = os.path.join(entry_dir, name + '.npy')
+            if is_object: # e.g. suite2p stat, cannot be memory-mapped
+                arrays[name] = np.load(npy_path, allow_pickle=True)
+            else:
+                arrays[name] = np.load(npy_path, mmap_mode=self.mmap_mode)
+        os.utime(meta_path) # last used, for eviction
+        return arrays
+
+    def save(self, stage, key, arrays, params=None):
+        """ Stores a dict of arrays under stage/key, then evicts least recently used entries above max_GB """
+        entry_dir = os.path.join(self.cache_dir, stage, key)
+        tmp_dir = entry_dir + '_tmp' + str(os.getpid())
+        os.makedirs(tmp_dir, exist_ok=True)
+        meta = {'arrays': {}, 'params': params}
+        for name, arr in arrays.items():
+            arr = np.asarray(arr)
+            meta['arrays'][name] = bool(arr.dtype.hasobject)
+            np.save(os.path.join(tmp_dir, name + '.npy'), arr, allow_pickle=arr.dtype.hasobject)
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+            json.dump(meta, f, default=str)
+        try:
+            os.replace(tmp_dir, entry_dir) # complete entries only
+        except OSError: # already written, e.g. by another process
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        self.evict()
+
+    def get_or_compute(self, stage, source_paths, params, compute_fun):
+        """ Loads arrays from the cache, or runs compute_fun() (returning a dict of arrays) and caches its output
+        :param: stage        - name of the cached step, e.g. 's2p_loader'
+        :param: source_paths - file(s)/folder(s) the step reads
+        :param: params       - (json-serialisable) parameters of the step
+        :param: compute_fun  - function without arguments returning a dict of arrays
+        :output: arrays      - dict of arrays (memory-mapped if loaded from the cache)
+        """
+        key = self.key(stage, source_paths, params)
+        t0 = time()
+        arrays = self.load(stage, key)
+        if arrays is not None:
+            self._count(stage, 'hits', time()-t0)
+            if self.verbose: print(f'{stage}: loaded from cache {key}')
+            return arrays
+        arrays = compute_fun()
+        self._count(stage, 'misses', time()-t0)
+        self.save(stage, key, arrays, params=params)
+        return arrays
+
+    def entries(self):
+        """ Dataframe of cached entries with their size and last use """
+        entries = []
+        for stage in os.listdir(self.cache_dir):
+            if not os.path.isdir(os.path.join(self.cache_dir, stage)):
+                continue
+            for key in os.listdir(os.path.join(self.cache_dir, stage)):
+                if '_tmp' in key: # entry being written (by this or another process), not evictable
+                    continue
+                entry_dir = os.path.join(self.cache_dir, stage, key)
+                meta_path = os.path.join(entry_dir, 'meta.json')
+                files = [os.path.join(entry_dir, f) for f in os.listdir(entry_dir)]
+                entries.append({'stage': stage, 'key': key, 'path': entry_dir,
+                                'bytes': sum(os.path.getsize(f) for f in files),
+                                'lastUsed': os.path.getmtime(meta_path) if os.path.exists(meta_path) else 0})
+        return pd.DataFrame(entries, columns=['stage', 'key', 'path', 'bytes', 'lastUsed'])
+
+    def evict(self, max_GB=None):
+        """ Removes least recently used entries until the cache is below max_GB (default self.max_bytes) """
+        max_bytes = self.max_bytes if max_GB is None else max_GB * 1e9
+        entries = self.entries().sort_values('lastUsed', ascending=False)
+        is_over = entries['bytes'].cumsum() > max_bytes
+        for entry_dir in entries['path'][is_over]:
+            if self.verbose: print('Evicting from cache: ' + entry_dir)
+            meta_path = os.path.join(entry_dir, 'meta.json')
+            if os.path.exists(meta_path):
+                os.remove(meta_path) # invalidate first, .npy may still be memory-mapped
+            shutil.rmtree(entry_dir, ignore_errors=True)
+
+    def clear(self, stage=None):
+        if stage is None:
+            self.evict(max_GB=0)
+        else:
+            shutil.rmtree(os.path.join(self.cache_dir, stage), ignore_errors=True)
+
+    def report(self):
+        """ Per-stage hit/miss statistics """
+        report = pd.DataFrame.from_dict(self.stats, orient='index')
+        if len(report):
+            report['hitRate'] = report['hits'] / (report['hits'] + report['misses'])
+        print(report)
+        return report
+
+def s2p_load_cells(s2p_files, allROIsAreCells=False):
+    ''' Loads suite2p outputs (dict of file name: path) and keeps the ROIs that are cells, see s2p_loader
     '''
-    found_stat = False
+    all_cells = np.load(s2p_files['F.npy'], allow_pickle=True)
+    neuropil = np.load(s2p_files['Fneu.npy'], allow_pickle=True)
+    is_cells = np.load(s2p_files['iscell.npy'], allow_pickle=True)[:, 0]
+    is_cells = np.ndarray.astype(is_cells, 'bool')
+    if allROIsAreCells:
+        is_cells = np.full(len(is_cells), True)
+        print(f"loading {sum(is_cells)} traces (ignoring True/False set by iscell.npy)")
+    else:
+        print('loading {} traces labelled as cells'.format(sum(is_cells)))
+    spks = np.load(s2p_files['spks.npy'], allow_pickle=True)
+    stat = np.load(s2p_files['stat.npy'], allow_pickle=True)
+
+    for i, s in enumerate(stat):
+        s['original_index'] = i
+
+    return {'all_cells': all_cells[is_cells, :],
+            'neuropil': neuropil[is_cells, :],
+            'spks': spks[is_cells, :],
+            'stat': stat[is_cells]}
 
+def s2p_load(s2p_path, allROIsAreCells=False, cache=None):
+    ''' Finds the suite2p outputs in s2p_path and loads the cells' F, Fneu, spks and stat (see s2p_load_cells),
+        from cache (NpyCache) if given
+    '''
+    s2p_files = {}
     for root, dirs, files in os.walk(s2p_path):
 
         for file in files:
 
-            if file == 'F.npy':
-                all_cells = np.load(os.path.join(root, file), allow_pickle=True)
-            elif file == 'Fneu.npy':
-                neuropil = np.load(os.path.join(root, file), allow_pickle=True)
-            elif file == 'iscell.npy':
-                is_cells = np.load(os.path.join(root, file), 
-                                   allow_pickle=True)[:, 0]
-                is_cells = np.ndarray.astype(is_cells, 'bool')
-                if allROIsAreCells:
-                    is_cells = np.full(len(is_cells), True)
-                    print(f"loading {sum(is_cells)} traces (ignoring True/False set by iscell.npy)")
-                else:
-                    is_cells = is_cells
-                    print('loading {} traces labelled as cells'.format(sum(is_cells)))
-            elif file == 'spks.npy':
-                spks = np.load(os.path.join(root, file), allow_pickle=True)
-            elif file == 'stat.npy':
-                stat = np.load(os.path.join(root, file), allow_pickle=True)
-                found_stat = True
-
-    if not found_stat:
+            if file in ['F.npy', 'Fneu.npy', 'iscell.npy', 'spks.npy', 'stat.npy']:
+                s2p_files[file] = os.path.join(root, file)
+
+    if 'stat.npy' not in s2p_files:
         raise FileNotFoundError('Could not find stat, '
                                 'this is likely not a suit2p folder')
-    for i, s in enumerate(stat):
-        s['original_index'] = i
-
-    all_cells = all_cells[is_cells, :]
-    neuropil = neuropil[is_cells, :]
-    spks = spks[is_cells, :]
-    stat = stat[is_cells]
+    if cache is None:
+        return s2p_load_cells(s2p_files, allROIsAreCells=allROIsAreCells)
+    return cache.get_or_compute('s2p_loader', sorted(s2p_files.values()), 
+                                {'allROIsAreCells': allROIsAreCells},
+                                lambda: s2p_load_cells(s2p_files, allROIsAreCells=allROIsAreCells))
 
+def s2p_loader(s2p_path, subtract_neuropil=True, neuropil_coeff=0.7, allROIsAreCells=False, cache=None):
+    '''28/05/2024: ST added allROIsAreCells to tell s2p_loader whether to consider all ROIs as cells or 
+                    follow iscell.npy
+       Added cache (NpyCache) to reuse the loaded cells across calls, returned arrays are then read-only
+    '''
+    s2p_cells = s2p_load(s2p_path, allROIsAreCells=allROIsAreCells, cache=cache)
+    all_cells, neuropil = s2p_cells['all_cells'], s2p_cells['neuropil']
+    spks, stat = s2p_cells['spks'], s2p_cells['stat']
 
     if not subtract_neuropil:
         return all_cells, spks, stat
@@ -1278,45 +1675,141 @@ def preprocess_flu(dfof, detrend=True, smooth_method='savgol', smooth_kw={}, do_
     
     return flu
 
-def flu_preprocess_splitter(info_recList, blockName, params, **preprocess_flu_kwargs):
+def preprocess_flu_cached(imDataPath, blockName=None, cache=None, **preprocess_flu_kwargs):
+    """ preprocess_flu of the flu in imaging-data.pkl (imDataPath), with the defaults of flu_preprocess_splitter.
+    cache (NpyCache) reuses the output for the same imaging-data.pkl and preprocessing parameters (not used when plotting)
+    :output: flu    - preprocessed flu (cell x time), read-only memory-mapped if loaded from cache
+    """
+    default_preprocess_flu = {'detrend':True, 
+                              'plot':False, 
+                              'smooth_method': 'savgol', 
+                              'do_zscore': True}
+    preprocess_flu_argin = {**default_preprocess_flu, **preprocess_flu_kwargs}
+    compute_flu = lambda: preprocess_flu(pd.read_pickle(imDataPath)['flu'], blockName=blockName, **preprocess_flu_argin)
+    if (cache is None) or preprocess_flu_argin['plot']:
+        return compute_flu()
+    cache_params = {k: v for k, v in preprocess_flu_argin.items() if k not in ['plot', 'plot_kw', 'savefigfolder']}
+    return cache.get_or_compute('preprocess_flu', imDataPath, cache_params, lambda: {'flu': compute_flu()})['flu']
+
+def epoch_flu_to_stimuli(flu, frame_clock, beh_df, preStim_s=3, postStim_s=6, fRate=15, fs=20000, dtype=None):
+    """ Splits flu (cell x time) into a cell x time x trial block around each stimulus onset of beh_df 
+    (stimulusOnsetTime + trialOffsets, see align_events_to_frames and epoch_trials); trials outside of the imaging are NaN 
+    :param: frame_clock - imaging frame times in samples of fs (e.g. from ..._imaging_frames.txt)
+    :param: fRate       - imaging frame rate, for the pre/post stimulus frames
+    """
+    pre_frames, post_frames = int(np.ceil(preStim_s*fRate)), int(np.ceil(postStim_s*fRate))
+    visTimes    = beh_df['stimulusOnsetTime'] + beh_df['trialOffsets']
+    # Express stim times as 2p_frame imaging frames (and paqIO indices of those frames)
+    stim2pFrames, _ = align_events_to_frames(frame_clock, visTimes, fs=fs)
+    return epoch_trials(flu, stim2pFrames, pre_frames, post_frames, dtype=dtype)
+
+def flu_preprocess_splitter(info_recList, blockName, params, cache=None, **preprocess_flu_kwargs):
     """ ST 04/2025: Code that converts extracted s2p-flu in imaging-data.pkl into a 3-dimensional 
     flu block of cell x time x trial
+    Trials outside of the imaging session are NaN padded (see epoch_trials), so trial axis matches beh_df rows
+    cache (NpyCache) reuses preprocess_flu output for the same imaging-data.pkl and preprocessing parameters 
+    (not used when plotting)
     """
 
     default_params = {'preStim_s': 3,
                       'postStim_s': 6, 
-                      'fRate': 15,}
+                      'fRate': 15,
+                      'dtype': None,} # np.float32 halves the memory of the trial block
     params = {**default_params, **params}
 
-    default_preprocess_flu = {'detrend':True, 
-                              'plot':False, 
-                              'smooth_method': 'savgol', 
-                              'do_zscore': True}
-    preprocess_flu_argin = {**default_preprocess_flu, **preprocess_flu_kwargs}
     ind = dfIndFromValue(blockName, info_recList.blockName)[0]
-    imData = pd.read_pickle(os.path.join(info_recList.analysisPath[ind], 'imaging-data.pkl'))
+    imDataPath = os.path.join(info_recList.analysisPath[ind], 'imaging-data.pkl')
     filenameTXT = os.path.join(info_recList.rawBlockPath[ind]) + '\*_imaging_frames.txt'
     filenameTXT= [f for f in glob.glob(filenameTXT)]  
-    frame_clock = pd.read_csv(filenameTXT[0],  header= None)
+    frame_clock = load_frame_count(filenameTXT[0])
     beh_df = pd.read_csv(info_recList.behFileName[ind].replace('.csv', '_withLicks.csv'))
 
-    preStim_s = params['preStim_s']
-    postStim_s = params['postStim_s']
-    fRate = params['fRate']
-    pre_frames, post_frames = int(np.ceil(preStim_s*fRate)), int(np.ceil(postStim_s*fRate))
-    visTimes    = beh_df['stimulusOnsetTime'] + beh_df['trialOffsets']
-    # Express stim, reward, choice times as paqIO indices
-    stimFrameTimes    = stim_start_frame_Dual2Psetup (frame_clock, visTimes)
-    # Convert paqIO indices into 2p_frame imaging frames
-    stim2pFrames = dfIndFromValue(stimFrameTimes, frame_clock)
-
     # Load data
-    fluR = imData['flu']
-    flu = preprocess_flu(fluR, blockName=blockName, **preprocess_flu_argin)
-    data = flu_splitter(flu, stim2pFrames, pre_frames, post_frames)
+    flu = preprocess_flu_cached(imDataPath, blockName=blockName, cache=cache, **preprocess_flu_kwargs)
+    data = epoch_flu_to_stimuli(flu, frame_clock, beh_df, preStim_s=params['preStim_s'], postStim_s=params['postStim_s'], 
+                                fRate=params['fRate'], dtype=params['dtype'])
     # print(data.shape) # cell x time x trials
     return data
 
+def epoch_trials(data, t_starts, pre_frames, post_frames, dtype=None, out=None, as_view=False):
+    """ Splits a continuous cell x time matrix into a cell x time x trial block.
+    The trial index matrix is built once and all trials are gathered with a single np.take into a 
+    preallocated array. Frames outside of the recording and trials with a NaN onset are NaN padded, 
+    so the trial axis always matches t_starts.
+    :param: data        - (cell x time) array, or a single trace (time)
+    :param: t_starts    - imaging frame of each trial onset (trials), NaN allowed; 
+                          or (cell x trials) for cell-specific onsets, e.g. multi-plane recordings
+    :param: pre_frames  - number of frames before t_start to include in the trial
+    :param: post_frames - number of frames from t_start on to include in the trial
+    :param: dtype       - output dtype, e.g. np.float32 to halve the memory. Default is data dtype (float64 for integer data)
+    :param: out         - optional preallocated (cell x time x trial) array to fill, e.g. to reuse across sessions
+    :param: as_view     - if True, returns a read-only view of data (no copy) when all trials are inside the 
+                          recording and equally spaced, and dtype is unchanged. Otherwise a copy is returned.
+
+    :output: trials     - (cell x time x trial) array, (time x trial) if data is a single trace
+    """
+    data = np.asarray(data)
+    single_trace = data.ndim == 1
+    if single_trace:
+        data = data[np.newaxis, :]
+    n_cells, n_frames = data.shape
+    starts = np.asarray(t_starts, dtype=float)
+    if (starts.ndim == 2) and (starts.shape[0] == 1):
+        starts = starts[0]
+    assert (starts.ndim == 1) or (starts.shape[0] == n_cells), 'epoch_trials: t_starts should be (trials) or (cell x trials)'
+    n_trials = starts.shape[-1]
+    n_time = pre_frames + post_frames
+    if dtype is None:
+        dtype = data.dtype if np.issubdtype(data.dtype, np.floating) else np.float64
+
+    if as_view:
+        is_viewable = ((out is None) and (starts.ndim == 1) and (n_trials > 0) and (np.dtype(dtype) == data.dtype)
+                       and np.all(np.isfinite(starts)))
+        if is_viewable:
+            steps = np.diff(starts)
+            step = int(steps[0]) if n_trials > 1 else 1
+            is_viewable = (np.all(starts == np.round(starts)) and np.all(steps == step) and (step > 0)
+                           and (starts[0] - pre_frames >= 0) and (starts[-1] + post_frames <= n_frames))
+        if is_viewable:
+            windows = np.lib.stride_tricks.sliding_window_view(data, n_time, axis=1) # cell x window start x time
+            first = int(starts[0]) - pre_frames
+            trials = windows[:, first:first + step*n_trials:step, :].transpose(0, 2, 1)
+            return trials[0] if single_trace else trials
+        print('epoch_trials: trials are not equally spaced inside the recording, returning a copy')
+
+    if out is None:
+        out = np.empty((n_cells, n_time, n_trials), dtype=dtype)
+    else:
+        assert out.shape == (n_cells, n_time, n_trials), 'epoch_trials: out should be ' + str((n_cells, n_time, n_trials))
+
+    offsets = np.arange(-pre_frames, post_frames)
+    if starts.ndim == 1:
+        idx = offsets[:, np.newaxis] + starts[np.newaxis, :] # time x trial
+    else:
+        idx = offsets[np.newaxis, :, np.newaxis] + starts[:, np.newaxis, :] # cell x time x trial
+    is_valid = (idx >= 0) & (idx < n_frames) # NaN onsets are False
+    idx = np.where(is_valid, idx, 0).astype(np.intp)
+
+    if starts.ndim == 1:
+        source, axis = data, 1
+    else:
+        idx += np.arange(n_cells)[:, np.newaxis, np.newaxis] * n_frames
+        source, axis = data.ravel(), None
+
+    if out.dtype == data.dtype:
+        np.take(source, idx, axis=axis, out=out, mode='clip')
+    else:
+        # np.take would cast through a full size temporary, gather blocks of trials instead
+        n_block = max(1, 2**24 // max(1, n_cells*n_time))
+        for first in range(0, n_trials, n_block):
+            out[:, :, first:first + n_block] = np.take(source, idx[..., first:first + n_block], axis=axis, mode='clip')
+
+    if starts.ndim == 1:
+        out[:, ~is_valid] = np.nan
+    else:
+        out[~is_valid] = np.nan
+    return out[0] if single_trace else out
+
 def select_by_peak_distance(peaks, vector_peaks, distance):
     """ ST: copied from scipy/scipy/signal/
     Evaluate which peaks fulfill the distance condition.
@@ -1581,10 +2074,101 @@ def test_responsive_pre_post(dff_pre, dff_post, testType='ttest'):
 
     return meandff_pre, meandff_post, pvals
 
+def fdr_bh(pvals, alpha=0.05):
+    """ Benjamini-Hochberg false discovery rate correction over all values of pvals (any shape, NaNs are ignored)
+    :output: reject     = (bool array, shape of pvals) significant after correction
+    :output: pvals_fdr  = (array, shape of pvals) adjusted p-values (NaN where pvals is NaN)
+    """
+    pvals = np.asarray(pvals, dtype=float)
+    pvals_fdr = np.full(pvals.shape, np.nan)
+    valid = ~np.isnan(pvals)
+    p = pvals[valid]
+    if len(p):
+        order = np.argsort(p)
+        p_adj = p[order] * len(p) / np.arange(1, len(p)+1)
+        p_adj = np.minimum.accumulate(p_adj[::-1])[::-1] # step-up: adjusted p is the min over all larger ranks
+        p_fdr = np.empty(len(p))
+        p_fdr[order] = np.minimum(p_adj, 1)
+        pvals_fdr[valid] = p_fdr
+    return pvals_fdr <= alpha, pvals_fdr
+
+def permutation_test_paired(meandff_pre, meandff_post, n_perm=1000, chunk_MB=256, seed=0):
+    """ Two-sided permutation test of post vs pre for every cell, shuffling the pre/post labels within each trial 
+    (i.e. random sign flips of the per-trial differences), statistic is the mean difference across trials
+    :param: meandff_pre, meandff_post = cell x trial arrays (NaN trials are dropped per cell)
+    :param: n_perm    = number of permutations, computed in chunks of permutations of at most chunk_MB
+    :param: seed      = seed of np.random.default_rng for reproducible p-values
+    :output: pvals    = (ncell,) (1 + n_perm with |null| >= |observed|) / (1 + n_perm)
+    """
+    diff = np.asarray(meandff_post, dtype=float) - np.asarray(meandff_pre, dtype=float) #cell x trial
+    valid = ~np.isnan(diff)
+    diff = np.where(valid, diff, 0)
+    n_trials = valid.sum(axis=1)
+    observed = np.abs(diff.sum(axis=1)) # sums instead of means: same n_trials within a cell
+    rng = np.random.default_rng(seed)
+    chunk = max(1, int(chunk_MB*1e6 // (8*(diff.shape[0]+diff.shape[1]))))
+    n_extreme = np.zeros(diff.shape[0])
+    for start in range(0, n_perm, chunk):
+        signs = rng.choice(np.array([-1., 1.]), size=(min(chunk, n_perm-start), diff.shape[1])) #perm x trial
+        null = np.abs(signs @ diff.T) #perm x cell
+        n_extreme += np.sum(null >= observed - 1e-12*np.abs(observed), axis=0) # tolerance for float ties
+    pvals = (1 + n_extreme) / (1 + n_perm)
+    pvals[n_trials==0] = np.nan
+    return pvals
+
+def test_responsive_batch(dffTrace_aligned, pre_window, post_window, baseline_window=None, trialTypes=None,
+                          tests=None, n_perm=0, perm_chunk_MB=256, seed=0, p_alpha=0.05):
+    """ Pre vs post responsiveness of all cells for all trial types, from the cell x time x trial dffTrace without copying it
+    :param: dffTrace_aligned = (dict) trialType > cell x time x trial array
+    :param: pre_window, post_window = (range or slice) frames (time axis) of the pre and post windows
+    :param: baseline_window  = (range or slice) frames of the baseline subtracted per cell per trial (as dFF_BaselineNormalisation),
+                               None to not normalise; applied to the window means, so the normalised trace is never built
+    :param: tests            = any of 'ttest' (stats.ttest_ind), 'wilcoxon' (stats.wilcoxon) and 'cohens_d' (cohend) (default None: all 3), 
+                               each computed for all cells at once on the cell x trial window means
+    :param: n_perm           = if >0, also a trial-shuffle permutation test ('permutation', see permutation_test_paired)
+    :param: p_alpha          = alpha of the Benjamini-Hochberg correction, over all cells x trial types of each test
+    :output: results         = (dict) test > trialType > (ncell,) p-values (Cohen's d values for 'cohens_d'),
+                               test+'_fdr' > trialType > BH adjusted p-values, 'meandff_pre'/'meandff_post' > trialType > cell x trial,
+                               'trials' > trialType > indices of the trials used (trials that are NaN for all cells are dropped,
+                               other NaN trials are omitted per cell by all tests)
+    """
+    trialTypes = list(dffTrace_aligned.keys()) if trialTypes is None else trialTypes
+    as_slice = lambda window: slice(window.start, window.stop) if isinstance(window, range) and window.step == 1 else window
+    pre_window, post_window, baseline_window = as_slice(pre_window), as_slice(post_window), as_slice(baseline_window)
+
+    results = {'meandff_pre': {}, 'meandff_post': {}, 'trials': {}}
+    for tType in trialTypes:
+        dff = dffTrace_aligned[tType] #cell x time x trial
+        meandff_pre = np.nanmean(dff[:, pre_window, :], axis=1) #cell x trial
+        meandff_post = np.nanmean(dff[:, post_window, :], axis=1) #cell x trial
+        if baseline_window is not None:
+            baselineMean = np.mean(dff[:, baseline_window, :], axis=1) #cell x trial
+            meandff_pre, meandff_post = meandff_pre - baselineMean, meandff_post - baselineMean
+        # trials that are NaN for every cell (e.g. NaN padded by epoch_trials, outside the imaging) are dropped
+        is_imaged = ~(np.all(np.isnan(meandff_pre), axis=0) | np.all(np.isnan(meandff_post), axis=0))
+        results['trials'][tType] = np.where(is_imaged)[0]
+        results['meandff_pre'][tType], results['meandff_post'][tType] = meandff_pre[:, is_imaged], meandff_post[:, is_imaged]
+
+    # remaining NaN trials are left out per cell by every test
+    testFuns = {'ttest': lambda pre, post: stats.ttest_ind(pre, post, axis=1, nan_policy='omit')[1],
+                'wilcoxon': lambda pre, post: stats.wilcoxon(pre, post, axis=1, nan_policy='omit')[1],
+                'cohens_d': lambda pre, post: cohend(pre, post, axis=1),
+                'permutation': lambda pre, post: permutation_test_paired(pre, post, n_perm=n_perm, chunk_MB=perm_chunk_MB, seed=seed)}
+    tests = ['ttest', 'wilcoxon', 'cohens_d'] if tests is None else list(tests)
+    tests = tests + (['permutation'] if n_perm > 0 and 'permutation' not in tests else [])
+    for test in tests:
+        results[test] = {tType: testFuns[test](results['meandff_pre'][tType], results['meandff_post'][tType]) 
+                         for tType in trialTypes}
+        if test != 'cohens_d' and len(trialTypes):
+            _, pvals_fdr = fdr_bh(np.stack([results[test][tType] for tType in trialTypes]), alpha=p_alpha)
+            results[test+'_fdr'] = dict(zip(trialTypes, pvals_fdr))
+    return results
+
 def test_responsive_acrossTrialTypes(dffTrace_aligned, params, frate=15, normalise=False,
                                      trialTypes=None, p_alpha=0.05):
     """ ST 03/2025: Iteratively return all cells in a dffTrace (cell x time x trial) 
         that respond significantly to any 1 trial type 
+        (Wilcoxon test of each trial type with test_responsive_batch)
     """
 
     default_params = {'pre_stim_s': 3,
@@ -1600,29 +2184,31 @@ def test_responsive_acrossTrialTypes(dffTrace_aligned, params, frate=15, normali
 
     dffTrace_startframe = int(np.ceil((params['pre_stim_s']-params['ttest_pre_stim_s'])*frate))
     dffTrace_endframe = int(np.ceil((params['pre_stim_s']+params['ttest_post_stim_s'])*frate))
-    dffTrace_framerange = range(dffTrace_startframe, dffTrace_endframe)
     
     ttest_pre = int(np.ceil(params['ttest_pre_stim_s'])*frate)
+    # windows within dffTrace (the pre/post split and the baseline are relative to dffTrace_startframe)
+    ncells = dffTrace_aligned[trialTypes[0]].shape[0]
+    nframes = dffTrace_aligned[trialTypes[0]].shape[1]
+    assert dffTrace_endframe <= nframes, \
+        f"dffTrace has {nframes} frames, {dffTrace_endframe} needed for ttest_post_stim_s={params['ttest_post_stim_s']}s after pre_stim_s={params['pre_stim_s']}s"
+    pre_window = range(dffTrace_startframe, min(dffTrace_startframe+ttest_pre, dffTrace_endframe))
+    post_window = range(dffTrace_startframe+ttest_pre, dffTrace_endframe)
+    baseline_window = range(dffTrace_startframe, min(dffTrace_startframe+int(np.ceil(params['ttest_pre_stim_s']*frate)), 
+                                                     dffTrace_endframe)) if normalise else None
+
+    results = test_responsive_batch(dffTrace_aligned, pre_window, post_window, baseline_window=baseline_window, 
+                                    trialTypes=trialTypes, tests=['wilcoxon'], p_alpha=p_alpha)
+    pval_alltrialTypes = results['wilcoxon']
 
-    pval_alltrialTypes = {}
     significant_cells = []
     for tType in trialTypes:
-            dffTrace_aligned_tType = dffTrace_aligned[tType][:,dffTrace_framerange,:] #cell x time x trial
-            if normalise:
-                dffTrace_aligned_tType = dFF_BaselineNormalisation(dffTrace_aligned_tType, 
-                                                                   range(int(np.ceil(params['ttest_pre_stim_s']*frate))), 3)
-            dffTrace_pre = dffTrace_aligned_tType[:,:ttest_pre,:]
-            dffTrace_post = dffTrace_aligned_tType[:,ttest_pre:,:]
-            
-            _,_,pvals = test_responsive_pre_post(dffTrace_pre, dffTrace_post, testType='wilcoxon')
-            pval_alltrialTypes[tType] = pvals
-
-            significant_cells.append(np.where(pvals<p_alpha)[0])
-            if params['verbose']: print(f"{len(np.where(pvals<p_alpha)[0])} / {pvals.shape[0]} cells significant for {tType} trials")
+        pvals = pval_alltrialTypes[tType]
+        significant_cells.append(np.where(pvals<p_alpha)[0])
+        if params['verbose']: print(f"{len(np.where(pvals<p_alpha)[0])} / {pvals.shape[0]} cells significant for {tType} trials")
 
     significant_cells = flatten_lists(significant_cells)
     significant_cells = np.unique(significant_cells)
-    print(f"{len(significant_cells)} / {pvals.shape[0]} unique cells significant (-{params['ttest_pre_stim_s']}s vs +{params['ttest_post_stim_s']}s) (alpha = {p_alpha})")
+    print(f"{len(significant_cells)} / {ncells} unique cells significant (-{params['ttest_pre_stim_s']}s vs +{params['ttest_post_stim_s']}s) (alpha = {p_alpha})")
     print("--------------------")
 
     return pval_alltrialTypes, significant_cells
@@ -1637,9 +2223,13 @@ def wide_long_df_from_dffTrace(dffTrace, info_session, alignment='StimulusAligne
     :param: frate           = (num) imaging frame rate in fps
     :param: normalise       = (bool) whether or not to normalise dff per cell per trial to its prewindow_s baseline
     :param: cells_ind       = (num or list) indexes of cells to include in dictionary output (if default None, will include all cells in dffTrace)
-    :param: stack_time      = (bool or str) default False: dff as array in column dff / 
+    :param: stack_time      = (bool or str) default False: dff as array in column dff (one array object per row; 
+                              'column'/'row' are built without per-row objects) / 
                               'row': dff for each frame is stacked in row, and denoted by new column frame_number (allows plotting using sns.lineplot(x='frame_number'), but takes time)
                               'column': dff for each frame is stacked along column, frame number denoted by column name 'frame_#' (for Antara's decoding analysis)
+    :param: save            = (bool or str) True pickles {params, df} to analysisPath/widelongform_df.pkl, 
+                              'parquet' writes a dataset partitioned by trialType to analysisPath/widelongform_df.parquet 
+                              (always column-stacked; load selected cells/trial types with read_widelongform_parquet)
 
     :output: session_dict   = (dict) with keys: expRef, animalID, cellID, trialNumber, trialType, 
                                                 (dff or frame_# of nframes), (opt: frame_number)
@@ -1672,17 +2262,14 @@ def wide_long_df_from_dffTrace(dffTrace, info_session, alignment='StimulusAligne
     dffTrace_aligned = dffTrace[alignment]
     ncells = dffTrace_aligned[list(dffTrace_aligned.keys())[0]].shape[0]
     cells_ind = range(ncells) if cells_ind is None else cells_ind  # some cells or all cells
-    try: iter(cells_ind)
-    except: cells_ind = cells_ind
+    cells_ind = np.atleast_1d(np.asarray(cells_ind, dtype=int))
 
     print(f"utils: Creating a longform dictionary for {len(cells_ind)} cells in {blockName} (stacking dff: {stack_time})")
 
-    expRef, animalID, cellID, trialNumber, trialType, frame_number, dff = [], [], [], [], [], [], []
-    #Determine which trials to include
+    # Rows are ordered trialType > cell > trial, the id columns are repeated/tiled from the tensor shape
     trialTypes = params['trialTypes']
-    
+    dff, cellID, trialNumber, trialType = [], [], [], []
     for tType in trialTypes:
-        # print(tType)
         if not params['include_all_frames']:
             dffTrace_stimAligned_tType = dffTrace_aligned[tType][:,dffTrace_framerange,:] #cell x time x trial
         else: dffTrace_stimAligned_tType = dffTrace_aligned[tType][:,:,:] #cell x time x trial
@@ -1691,35 +2278,38 @@ def wide_long_df_from_dffTrace(dffTrace, info_session, alignment='StimulusAligne
             dffTrace_celltimetrial = dFF_BaselineNormalisation(dffTrace_stimAligned_tType, 
                                                                range(int(np.ceil(params['prewindow_s']*frate))), 3)
         else: dffTrace_celltimetrial = dffTrace_stimAligned_tType
-        
-        for cell in cells_ind:
-            for trial_ind, trial in enumerate(dffTrace['trialIndices'][tType]):
-                sub_dff = dffTrace_celltimetrial[cell,:,trial_ind] #1D array, of dff over frames/time
-                # If this error occurs, the trial type assignment has gone out of order
-                # assert beh_df[beh_df_tType_col][trial] == tType or beh_df[beh_df_tType_col][trial].startswith(tType), \
-                #     f"Expected {tType}, found {beh_df[beh_df_tType_col][trial]} in beh_df instead"
-                dff.append(sub_dff) #array with n flu for n frames
-
-                trialNumber = trialNumber + [int(trial+1) for _ in range(len(dff)-len(trialNumber))] 
-            cellID = cellID + [cell for _ in range(len(dff)-len(cellID))]
-        trialType = trialType + [tType for _ in range(len(dff)-len(trialType))]
-
-    expRef = [blockName for _ in range(len(dff))]
-    animalID = [animal for _ in range(len(dff))]
-
-    session_dict = {'expRef': expRef, 'animalID':animalID, 'cellID': cellID, 
-                    'trialNumber': trialNumber, 'trialType': trialType}
-    
-    if not stack_time: 
-        output_df = pd.DataFrame({**session_dict, 'dff':dff})
-    elif stack_time=='column' or stack_time=='row': # needs more testing
-        if len(np.array(dff).shape)>1: #.shape comes as a two-digit tuple corresponding to cell/trial x time
-            output_df = pd.DataFrame(session_dict)
-            output_df = pd.concat([output_df, pd.DataFrame(dff)], axis=1)
-            if stack_time=='row': 
-                output_df = output_df.melt(id_vars=['animalID', 'expRef', 'cellID', 'trialNumber', 'trialType'], var_name='frame_number', value_name='dff')
+
+        trials = np.asarray(dffTrace['trialIndices'][tType], dtype=int)
+        assert dffTrace_celltimetrial.shape[2] == len(trials), \
+            f"{tType}: {dffTrace_celltimetrial.shape[2]} trials in dffTrace['{alignment}'] but {len(trials)} in dffTrace['trialIndices']"
+        sub_dff = dffTrace_celltimetrial[cells_ind] # cell x time x trial
+        dff.append(sub_dff.transpose(0, 2, 1).reshape(-1, sub_dff.shape[1])) # (cell, trial) x time
+        cellID.append(np.repeat(cells_ind, len(trials)))
+        trialNumber.append(np.tile(trials+1, len(cells_ind)))
+        trialType.append(np.repeat(np.array([tType]), len(cells_ind)*len(trials)))
+
+    dff = np.concatenate(dff, axis=0) # row x time
+    nrows, nframes = dff.shape
+    session_dict = {'expRef': np.repeat(np.array([blockName]), nrows),
+                    'animalID': np.repeat(np.array([animal]), nrows),
+                    'cellID': np.concatenate(cellID), 'trialNumber': np.concatenate(trialNumber),
+                    'trialType': np.concatenate(trialType)}
+
+    if not stack_time:
+        output_df = pd.DataFrame({**session_dict, 'dff': list(dff)}) # object column: one view of the row x time array per row
+    elif stack_time=='column':
+        output_df = pd.concat([pd.DataFrame(session_dict), pd.DataFrame(dff)], axis=1)
+    elif stack_time=='row':
+        # same layout as melting the 'column' dataframe: all rows for frame 0, then frame 1, ...
+        id_vars = ['animalID', 'expRef', 'cellID', 'trialNumber', 'trialType']
+        output_df = pd.DataFrame(session_dict)[id_vars].take(np.tile(np.arange(nrows), nframes)).reset_index(drop=True)
+        output_df['frame_number'] = np.repeat(np.arange(nframes), nrows)
+        output_df['dff'] = dff.ravel(order='F')
     else: print(f"stack_time should be False, 'column' or 'row', but is: {stack_time}")
-    if save:
+    if save == 'parquet': # saved column-stacked whatever stack_time is
+        parquet_df = pd.concat([pd.DataFrame(session_dict), pd.DataFrame(dff)], axis=1)
+        save_widelongform_parquet(parquet_df, info_session.analysisPath, params={**params, 'stack_time': stack_time})
+    elif save:
         output_pickle = params.copy()
         output_pickle['stack_time'] = stack_time
         output_pickle['df'] = output_df
@@ -1730,6 +2320,75 @@ def wide_long_df_from_dffTrace(dffTrace, info_session, alignment='StimulusAligne
     if return_params: return output_df, params
     else: return output_df
 
+def save_widelongform_parquet(output_df, analysisPath, params=None, partition_cols=None,
+                              filename='widelongform_df.parquet'):
+    """ Writes the output of wide_long_df_from_dffTrace as a parquet dataset (one folder per trialType), so 
+    read_widelongform_parquet only reads the folders of the requested trial types and filters cells while reading
+    :param: output_df       = dataframe from wide_long_df_from_dffTrace (any stack_time)
+    :param: analysisPath    = (str) session analysis folder, dataset is saved in analysisPath/filename
+    :param: params          = (dict) saved as _params.json in the dataset folder (files starting with _ are skipped by parquet readers)
+    :param: partition_cols  = (list) columns used as folder partitions (default None: ['trialType'])
+    :output: path           = (str) path of the dataset folder
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    partition_cols = ['trialType'] if partition_cols is None else partition_cols
+    path = os.path.join(analysisPath, filename)
+    if os.path.isdir(path): # partitioned writes append files, so remove the previous dataset
+        shutil.rmtree(path)
+    df = output_df.copy(deep=False)
+    df.columns = [str(col) for col in df.columns] # parquet column names need to be strings ('column' layout has frame numbers)
+    pq.write_to_dataset(pa.Table.from_pandas(df, preserve_index=False), path, partition_cols=partition_cols)
+
+    params = {} if params is None else params
+    with open(os.path.join(path, '_params.json'), 'w') as f:
+        json.dump({**params, 'columns': list(df.columns), 'partition_cols': partition_cols}, f, default=str, indent=1)
+    print(f"Saved wide/longform dataframe as parquet in {path}")
+    return path
+
+def read_widelongform_parquet(analysisPath, cells_ind=None, trialTypes=None, columns=None, stack_time='column',
+                              filename='widelongform_df.parquet', return_params=False):
+    """ Loads a dataset written by save_widelongform_parquet, reading only the requested cells and trial types
+    :param: analysisPath    = (str or list) session analysis folder(s); several sessions are concatenated
+    :param: cells_ind       = (num or list) cellIDs to load (default None: all cells)
+    :param: trialTypes      = (str or list) trial types to load (default None: all trial types)
+    :param: columns         = (list) columns to load (default None: all columns)
+    :param: stack_time      = 'column' returns the frame columns as saved, False gathers them back into a dff column of arrays 
+                              (layout of wide_long_df_from_dffTrace(stack_time=False))
+    :output: df             = dataframe with the saved columns (frame columns of the 'column' layout are ints again), rows grouped by trialType
+    """
+    import pyarrow.parquet as pq
+
+    analysisPaths = [analysisPath] if isinstance(analysisPath, str) else list(analysisPath)
+    filters = []
+    if cells_ind is not None:
+        filters.append(('cellID', 'in', [int(cell) for cell in np.atleast_1d(cells_ind)]))
+    if trialTypes is not None:
+        filters.append(('trialType', 'in', list(np.atleast_1d(trialTypes))))
+
+    dfs = []
+    for path in analysisPaths:
+        path = os.path.join(path, filename)
+        with open(os.path.join(path, '_params.json')) as f:
+            params = json.load(f)
+        df = pq.read_table(path, columns=columns, filters=filters if len(filters) else None).to_pandas()
+        for col in params['partition_cols']: # partitions come back as categoricals at the end of the table
+            if col in df.columns: df[col] = df[col].astype(object)
+        df = df[[col for col in params['columns'] if col in df.columns]]
+        if 'trialType' in df.columns and 'trialTypes' in params: # partitions are read in folder order
+            tType_order = df['trialType'].map({tType: i for i, tType in enumerate(params['trialTypes'])})
+            df = df.iloc[np.argsort(tType_order.to_numpy(), kind='stable')].reset_index(drop=True)
+        df.columns = [int(col) if col.isdigit() else col for col in df.columns]
+        dfs.append(df)
+    df = pd.concat(dfs, ignore_index=True) if len(dfs) > 1 else dfs[0]
+    frame_cols = [col for col in df.columns if isinstance(col, int)]
+    if not stack_time and len(frame_cols):
+        df = df.drop(columns=frame_cols).assign(dff=list(df[frame_cols].to_numpy()))
+
+    if return_params: return df, params
+    else: return df
+
 
 ############### OLD CODES ####################
 def intersect(lst1, lst2):
@@ -1843,18 +2502,55 @@ def shutter_start_frame(paq=None, stim_chan_name=None, frame_clock=None,
         stim_times = paq_data(paq, stim_chan_name,threshold, threshold_ttl=True)
 
     stim_times = [stim for stim in stim_times if stim < np.nanmax(frame_clock)]
-    frames = []
-
-    for stim in stim_times:
-        # the sample time of the frame immediately preceeding stim
-#         frame = next(frame_clock[i-1] for i, sample in enumerate(frame_clock[plane::n_planes])
-#                      if sample - stim > 0)
-        frame = next(i-1 for i, sample in enumerate(frame_clock[plane::n_planes])
-                     if sample - stim > 0)
-        frames.append(frame)
-    frames = np.transpose(frames)
+    # the index of the frame immediately preceeding each stim
+    frames = frame_clock_index(frame_clock, stim_times, plane=plane, n_planes=n_planes)
     return frames
 
+def frame_clock_index(frame_clock, event_samples, plane=0, n_planes=1):
+    ''' Returns the index (in frame_clock[plane::n_planes]) of the frame immediately
+        preceeding each event, i.e. one before the first frame with sample > event,
+        for all events in one call.
+        Frame clock must be digitised and expressed in the same reference frame as
+        event_samples. The clock's running maximum is searched with np.searchsorted,
+        which gives the same frame as scanning the clock for the first later sample,
+        even if the clock contains NaNs.
+        Events before the first frame return -1; NaN events and events after the
+        last frame are not meaningful and should be excluded by the caller
+        (see align_events_to_frames)
+    '''
+    clock = np.asarray(frame_clock, dtype=float).ravel()[plane::n_planes]
+    events = np.asarray(event_samples, dtype=float).ravel()
+    sorted_clock = np.fmax.accumulate(clock) if len(clock) else clock
+    sorted_clock[np.isnan(sorted_clock)] = -np.inf # NaNs before the first frame
+    return np.searchsorted(sorted_clock, events, side='right') - 1
+
+def align_events_to_frames(frame_clock, event_times, fs=None, plane=0, n_planes=1):
+    """ Batched alignment of events (e.g. stimulus onsets of every trial) to the imaging frame
+    immediately preceding each of them, as in stim_start_frame_Dual2Psetup
+    :param: frame_clock     - imaging frame times, e.g. from load_frame_count(..._imaging_frames.txt) (array, list, Series or 1-column DataFrame)
+    :param: event_times     - event times; in seconds if fs is given (multiplied by fs and rounded),
+                              otherwise already in the reference frame of frame_clock (e.g. paqIO samples)
+    :param: fs              - sampling rate of frame_clock, 20000Hz (for PAQio) or 2000Hz for daq
+    :param: plane, n_planes - for multi-plane recordings, align to frame_clock[plane::n_planes]
+
+    :output: frame_idx      - (float array) imaging frame index of the frame preceding each event, NaN for NaN events
+                              and events outside of the frame clock
+    :output: frame_samples  - (float array) frame_clock value of that frame (i.e. the output of stim_start_frame_Dual2Psetup), NaN likewise
+    """
+    clock = np.asarray(frame_clock, dtype=float).ravel()
+    events = np.asarray(event_times, dtype=float).ravel()
+    if fs is not None:
+        events = np.round(events*fs)
+
+    idx = frame_clock_index(clock, events, plane=plane, n_planes=n_planes)
+    in_range = ~np.isnan(events)
+    in_range[in_range] = (events[in_range] < np.nanmax(clock)) & (events[in_range] > np.nanmin(clock))
+
+    frame_idx = np.where(in_range, idx, np.nan)
+    frame_samples = np.full(len(events), np.nan)
+    frame_samples[in_range] = clock[plane::n_planes][idx[in_range]]
+    return frame_idx, frame_samples
+
 def stim_start_frame_Dual2Psetup(frame_clock, stim_times, fs=20000):
     # used in the analysis code.
     ''' Returns the frames from the frame_clock immediately preeceding stim.
@@ -1863,29 +2559,11 @@ def stim_start_frame_Dual2Psetup(frame_clock, stim_times, fs=20000):
     frame output is in terms of absolute paqIO frames (2p-frame), aligned to an imaging frame
     :param: fs  = 20000Hz (for PAQio) or 2000Hz for daq
     '''
-    if isinstance(frame_clock, np.ndarray)==False and isinstance(frame_clock, list)==False:
-        frame_clock = frame_clock.values #is this for if frame_clock is a dataframe, or a series?
-    if isinstance(stim_times, np.ndarray)==False and isinstance(stim_times, list)==False:
-        stim_times = stim_times.values
-
     plane=0
     n_planes=1 # might be useful in the future
-    stim_times = [np.round(i*fs) for i in stim_times] #ST take this out if input stim_times is already multiplied by 20000
-    # print(len(stim_times))
-    stim_times = [stim if (stim < np.nanmax(frame_clock)) or np.isnan(stim) else stim_times[i] for i, stim in enumerate(stim_times)]
-    # print(len(stim_times))
-    frames = []
-
-    for stim in stim_times:
-        if ~np.isnan(stim) and (stim < np.nanmax(frame_clock)) and (stim > np.nanmin(frame_clock)):
-        # the 2p frame number immediately preceding stim
-            frame = next(frame_clock[i-1] for i, sample in enumerate(frame_clock[plane::n_planes])
-                        if sample - stim > 0)
-            frame = int(frame) #ST added this to avoid function outputting a list of [(ndarray())...]
-        else:
-            frame = np.nan
-
-        frames.append(frame)
+    # the 2p frame number immediately preceding stim, NaN if stim is NaN or outside of frame_clock
+    _, frame_samples = align_events_to_frames(frame_clock, stim_times, fs=fs, plane=plane, n_planes=n_planes)
+    frames = [int(frame) if not np.isnan(frame) else np.nan for frame in frame_samples]
     return (frames)
 
 def stim_start_frame(paq=None, stim_chan_name=None, frame_clock=None,
@@ -1910,15 +2588,8 @@ def stim_start_frame(paq=None, stim_chan_name=None, frame_clock=None,
 
     stim_times = [stim for stim in stim_times if stim < np.nanmax(frame_clock)]
 
-    frames = []
-
-    for stim in stim_times:
-        # the sample time of the frame immediately preceeding stim
-#         frame = next(frame_clock[i-1] for i, sample in enumerate(frame_clock[plane::n_planes])
-#                      if sample - stim > 0)
-        frame = next(i-1 for i, sample in enumerate(frame_clock[plane::n_planes])
-                     if sample - stim > 0)
-        frames.append(frame)
+    # the index of the frame immediately preceeding each stim
+    frames = frame_clock_index(frame_clock, stim_times, plane=plane, n_planes=n_planes)
 
      # Exclude frames that are too close together
     first_ind = np.where(np.diff(frames)>interStimFrameMin)
@@ -2019,26 +2690,17 @@ def trace_splitter(trace,t_starts, pre_frames, post_frames):
 
        returns 
        trial_flu -- trial by trial array 
-                    [num_cells x trial frames x num_trials]
+                    [1 x trial frames x num_trials]
+                    (built by epoch_trials, trials running past the end of 
+                    the trace are NaN padded)
 
        '''
-    initial=True
-    trial_trace = np.array
-    for trial, t_start in enumerate(t_starts):
-        # the trial occured before imaging started
-    
-        if (t_start-pre_frames) > 0: #ignore first trial 
-        #     print('prb')
-        #     continue
-            flu_chunk = trace[t_start-pre_frames:t_start+post_frames]
-
-            if initial==True:
-                trial_trace = flu_chunk
-                initial = False
-            else:
-                trial_trace = np.dstack((trial_trace, flu_chunk))
+    t_starts = np.asarray(t_starts, dtype=float)
+    # the trial occured before imaging started
+    t_starts = t_starts[(t_starts-pre_frames) > 0] #ignore first trial 
+    trial_trace = epoch_trials(trace, t_starts, pre_frames, post_frames)
 
-    return trial_trace
+    return trial_trace[np.newaxis, :, :]
 
 def flu_splitter(flu,t_starts, pre_frames, post_frames):
     '''Split a fluoresence matrix into trial by trial array
@@ -2053,88 +2715,51 @@ def flu_splitter(flu,t_starts, pre_frames, post_frames):
        returns 
        trial_flu -- trial by trial array 
                     [num_cells x trial frames x num_trials]
+                    (built by epoch_trials, use it directly to keep 
+                    out-of-range trials as NaN instead of dropping them)
 
        '''
-    initial = True
-    # trial_flu = np.array
-    for trial, t_start in enumerate(t_starts):
-        # the trial occured before imaging started
-        if ((t_start-pre_frames) > 0 ) & ((t_start+post_frames)<flu.shape[1]):
-            flu_chunk = flu[:, t_start-pre_frames:t_start+post_frames]
-
-            if initial == True:
-                trial_flu = flu_chunk
-                initial = False
-            else:
-                trial_flu = np.dstack((trial_flu, flu_chunk))
+    flu = np.asarray(flu)
+    t_starts = np.asarray(t_starts, dtype=float)
+    # the trial occured before imaging started
+    is_inside = ((t_starts-pre_frames) > 0 ) & ((t_starts+post_frames)<flu.shape[1])
+    trial_flu = epoch_trials(flu, t_starts[is_inside], pre_frames, post_frames)
 
     return trial_flu
 
 
-def flu_splitter2(flu, stim_times, frames_ms, pre_frames=10, post_frames=30):
-
-    stim_idxs = stim_start_frame_Dual2Psetup (frames_ms, stim_times)
-
-    stim_idxs = stim_idxs[:, np.where((stim_idxs[0, :]-pre_frames > 0) &
-                                      (stim_idxs[0, :] + post_frames 
-                                      < flu.shape[1]))[0]]
-
-    n_trials = stim_idxs.shape[1]
-    n_cells = frames_ms.shape[0]
+def stim_idxs_from_frames_ms(frames_ms, stim_times):
+    ''' Frame index immediately preceding each stim for every row of frames_ms 
+        (see build_frames_ms), NaN for stims outside of the frame clock
+        returns stim_idxs -- [n_cells (or 1) x n_trials]
+        '''
+    frames_ms = np.atleast_2d(np.asarray(frames_ms, dtype=float))
+    stim_idxs = np.vstack([align_events_to_frames(clock, stim_times)[0] for clock in frames_ms])
+    return stim_idxs
 
-    for i, shift in enumerate(np.arange(-pre_frames, post_frames)):
-        if i == 0:
-            trial_idx = stim_idxs + shift
-        else:
-            trial_idx = np.dstack((trial_idx, stim_idxs + shift))
+def flu_splitter2(flu, stim_times, frames_ms, pre_frames=10, post_frames=30):
 
-    tot_frames = pre_frames + post_frames
-    trial_idx = trial_idx.reshape((n_cells, n_trials*tot_frames))
+    stim_idxs = stim_idxs_from_frames_ms(frames_ms, stim_times)
 
-    flu_trials = []
-    for i, idxs in enumerate(trial_idx):
-        idxs = idxs[~np.isnan(idxs)].astype('int')
-        flu_trials.append(flu[i, idxs])
+    is_inside = ((stim_idxs[0, :]-pre_frames > 0) &
+                 (stim_idxs[0, :] + post_frames < flu.shape[1]))
+    stim_idxs = stim_idxs[:, is_inside]
 
-    n_trials_valid = len(idxs)
-    flu_trials = np.array(flu_trials).reshape(
-        (n_cells, int(n_trials_valid/tot_frames), tot_frames))
+    flu_trials = epoch_trials(flu, stim_idxs, pre_frames, post_frames)
 
-    return flu_trials
+    return flu_trials.transpose(0, 2, 1) # cell x trial x time
 
 def flu_splitter3(flu, stim_times, frames_ms, pre_frames=10, post_frames=30):
 
-    stim_idxs = stim_start_frame_Dual2Psetup (frames_ms, stim_times)
+    stim_idxs = stim_idxs_from_frames_ms(frames_ms, stim_times)
 
     # not 100% sure about this line, keep an eye
-    stim_idxs[:, np.where((stim_idxs[0, :]-pre_frames <= 0) |
-                          (stim_idxs[0, :] + post_frames 
-                           >= flu.shape[1]))[0]] = np.nan
-
-    n_trials = stim_idxs.shape[1]
-    n_cells = frames_ms.shape[0]
-
-    for i, shift in enumerate(np.arange(-pre_frames, post_frames)):
-        if i == 0:
-            trial_idx = stim_idxs + shift
-        else:
-            trial_idx = np.dstack((trial_idx, stim_idxs + shift))
+    stim_idxs[:, ~((stim_idxs[0, :]-pre_frames > 0) &
+                   (stim_idxs[0, :] + post_frames < flu.shape[1]))] = np.nan
 
-    tot_frames = pre_frames + post_frames
-    trial_idx = trial_idx.reshape((n_cells, n_trials*tot_frames))
+    flu_trials = epoch_trials(flu, stim_idxs, pre_frames, post_frames)
 
-    # flu_trials = np.repeat(np.nan, n_cells*n_trials*tot_frames)
-    # flu_trials = np.reshape(flu_trials, (n_cells, n_trials, tot_frames))
-    flu_trials = np.full_like(trial_idx, np.nan)
-    # iterate through each cell and add trial frames
-    for i, idxs in enumerate(trial_idx):
-
-        non_nan = ~np.isnan(idxs)
-        idxs = idxs[~np.isnan(idxs)].astype('int')
-        flu_trials[i, non_nan] = flu[i, idxs]
-
-    flu_trials = np.reshape(flu_trials, (n_cells, n_trials, tot_frames))
-    return flu_trials
+    return flu_trials.transpose(0, 2, 1) # cell x trial x time
 
 def closest_frame_before(clock, t):
     ''' Returns the idx of the frame immediately preceeding 
@@ -2154,6 +2779,31 @@ def closest_frame(clock, t):
     subbed = np.array(clock) - t
     return np.argmin(abs(subbed))
 
+def stim_window_masks(n_frames, stim_times, pre_frames=10, post_frames=10, pre_offset=0, offset=0):
+    """ Boolean frame masks of the pre and post windows of all stims (used by test_responsive and test_cohens_d)
+    Stims that are NaN or whose windows do not fit in n_frames are skipped; warns for stims overlapping the previous one
+    :output: pre_idx, post_idx = (n_frames,) bool arrays
+    """
+    pre_idx = np.repeat(False, n_frames)
+    post_idx = np.repeat(False, n_frames)
+    stim_times = np.asarray(stim_times, dtype=float).ravel()
+    stim_num = np.where(~np.isnan(stim_times))[0]
+    stim_frames = stim_times[stim_num].astype(int)
+    fits = (stim_frames-pre_frames-pre_offset > 0) & (stim_frames+post_frames+offset < n_frames)
+    stim_num, stim_frames = stim_num[fits], stim_frames[fits]
+
+    # compare with the previous stim that was kept
+    prev_frames = np.concatenate([[0], stim_frames[:-1]])
+    for i in stim_num[stim_frames - pre_frames - pre_offset <= prev_frames]:
+        print('WARNING: STA for stim number {} overlaps with the '
+              'previous stim pre and post arrays can not be '
+              'reshaped to trial by trial'.format(i))
+
+    pre_frames_idx = (stim_frames[:,None] + np.arange(-pre_frames-pre_offset, -pre_offset)).ravel()
+    pre_idx[pre_frames_idx[pre_frames_idx < n_frames]] = True # a negative pre_offset can reach past the end, as slicing
+    post_idx[(stim_frames[:,None] + np.arange(offset, post_frames+offset)).ravel()] = True
+    return pre_idx, post_idx
+
 def test_responsive(flu, frame_clock, stim_times, pre_frames=10, 
                     post_frames=10, pre_offset=0, offset=0, testType = 'ttest', fluMean=False):
     ''' Tests if cells in a fluoresence array are significantly responsive 
@@ -2190,29 +2840,11 @@ def test_responsive(flu, frame_clock, stim_times, pre_frames=10,
 
     n_frames = flu.shape[1]
 
-    pre_idx = np.repeat(False, n_frames)
-    post_idx = np.repeat(False, n_frames)
-
     if fluMean==False: #means: flu -- fluoresence matrix [n_cells x n_frames] likely continuous dfof from suite2p
-        # keep track of the previous stim frame to warn against overlap
-        prev_frame = 0
-
-        for i, stim_frame in enumerate(stim_times):
-            if not np.isnan(stim_frame):
-                stim_frame = int(stim_frame)
-                if stim_frame-pre_frames-pre_offset <= 0 or stim_frame+post_frames+offset \
-                >= n_frames:
-                    continue
-                elif stim_frame - pre_frames - pre_offset <= prev_frame:
-                    print('WARNING: STA for stim number {} overlaps with the '
-                        'previous stim pre and post arrays can not be '
-                        'reshaped to trial by trial'.format(i))
-
-                prev_frame = stim_frame
-
-                pre_idx[stim_frame-pre_frames-pre_offset: stim_frame-pre_offset] = True
-                post_idx[stim_frame+offset: stim_frame+post_frames+offset] = True
+        pre_idx, post_idx = stim_window_masks(n_frames, stim_times, pre_frames, post_frames, pre_offset, offset)
     else: # means: flu -- trial-averaged fluoresence matrix [Cell x frames]
+        pre_idx = np.repeat(False, n_frames)
+        post_idx = np.repeat(False, n_frames)
         stim_frame = stim_times
         pre_idx[stim_frame-pre_frames-pre_offset: stim_frame-pre_offset] = True
         post_idx[stim_frame+offset: stim_frame+post_frames+offset] = True
@@ -2249,13 +2881,13 @@ def test_responsive_timeXtrial(dff1, dff2, stim_frame, post_frames=10, testType=
     return mean_dff1, mean_dff2, pvals
 
 def cohend(d1, d2, axis=None):
-    # calculate the size of samples
+    # calculate the size of samples (NaNs are ignored)
     if axis==None:
         n1, n2 = len(d1), len(d2)
     elif (type(axis)==float) or (type(axis)==int):
-        n1, n2 = d1.shape[axis], d2.shape[axis]
+        n1, n2 = np.sum(~np.isnan(d1), axis=axis), np.sum(~np.isnan(d2), axis=axis)
     # calculate the variance of the samples
-    s1, s2 = np.var(d1, ddof=1, axis=axis), np.var(d2, ddof=1, axis=axis)
+    s1, s2 = np.nanvar(d1, ddof=1, axis=axis), np.nanvar(d2, ddof=1, axis=axis)
     # calculate the pooled standard deviation
     s = np.sqrt(((n1 - 1) * s1 + (n2 - 1) * s2) / (n1 + n2 - 2))
     # calculate the means of the samples
@@ -2295,28 +2927,12 @@ def test_cohens_d(flu, stim_times, pre_frames=10,
 
         '''
     n_frames = flu.shape[1]
-    pre_idx = np.repeat(False, n_frames)
-    post_idx = np.repeat(False, n_frames)
 
     if fluMean==False: #means: flu -- fluoresence matrix [n_cells x n_frames] likely continuous dfof from suite2p
-        # keep track of the previous stim frame to warn against overlap
-        prev_frame = 0
-
-        for i, stim_frame in enumerate(stim_times):
-            stim_frame = int(stim_frame)
-            if stim_frame-pre_frames-pre_offset <= 0 or stim_frame+post_frames+offset \
-            >= n_frames:
-                continue
-            elif stim_frame - pre_frames - pre_offset <= prev_frame:
-                print('WARNING: STA for stim number {} overlaps with the '
-                    'previous stim pre and post arrays can not be '
-                    'reshaped to trial by trial'.format(i))
-
-            prev_frame = stim_frame
-
-            pre_idx[stim_frame-pre_frames-pre_offset: stim_frame-pre_offset] = True
-            post_idx[stim_frame+offset: stim_frame+post_frames+offset] = True
+        pre_idx, post_idx = stim_window_masks(n_frames, stim_times, pre_frames, post_frames, pre_offset, offset)
     else: # means: flu -- trial-averaged fluoresence matrix [Cell x frames]
+        pre_idx = np.repeat(False, n_frames)
+        post_idx = np.repeat(False, n_frames)
         stim_frame = stim_times
         pre_idx[stim_frame-pre_frames-pre_offset: stim_frame-pre_offset] = True
         post_idx[stim_frame+offset: stim_frame+post_frames+offset] = True
@@ -2427,40 +3043,117 @@ def averager(array_list, pre_frames=10, post_frames=50, offset=0,
 
     return session_average, scaled_average, grand_average, cell_average
 
-def lick_binner(paqData, trial_start, stChanName, threshold=1, distance=False, stimulation=False):
+class RaggedTrials():
+    """ Events (e.g. lick times) binned per trial, stored flat: the values of all trials
+    concatenated, and offsets so that trial i is values[offsets[i]:offsets[i+1]].
+    Behaves like the list of arrays lick_binner used to return: len(), iteration and ragged[i] 
+    (a view of values) work as before; ragged[list of trials] returns a RaggedTrials of those trials,
+    ragged1 + ragged2 concatenates trials (as list1 + list2) and tolist() gives the list of arrays.
+    """
+    def __init__(self, values, offsets):
+        self.values = np.asarray(values)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        assert self.offsets[0] == 0 and self.offsets[-1] == len(self.values), 'RaggedTrials: offsets do not match values'
+
+    @classmethod
+    def from_list(cls, arrays):
+        """ RaggedTrials from a list of arrays (or a RaggedTrials, returned as is) """
+        if isinstance(arrays, cls):
+            return arrays
+        arrays = [np.ravel(array) for array in arrays]
+        counts = [len(array) for array in arrays]
+        values = np.concatenate(arrays) if len(arrays) else np.array([])
+        return cls(values, np.concatenate(([0], np.cumsum(counts, dtype=np.int64))))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            key = range(len(self))[key] # negative indices
+            return self.values[self.offsets[key]:self.offsets[key+1]]
+        return self.select(key)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.values[self.offsets[i]:self.offsets[i+1]]
+
+    def __add__(self, other):
+        other = RaggedTrials.from_list(other)
+        return RaggedTrials(np.concatenate((self.values, other.values)),
+                            np.concatenate((self.offsets, other.offsets[1:] + self.offsets[-1])))
+
+    def __radd__(self, other):
+        return RaggedTrials.from_list(other) + self
+
+    def __repr__(self):
+        return f'RaggedTrials({len(self)} trials, {len(self.values)} values)'
+
+    def counts(self):
+        """ Number of values in each trial """
+        return np.diff(self.offsets)
+
+    def trial_index(self):
+        """ Trial of each value """
+        return np.repeat(np.arange(len(self)), self.counts())
+
+    def select(self, trials):
+        """ RaggedTrials of the selected trials (indices, boolean mask or slice), in the order given """
+        trials = np.arange(len(self))[trials]
+        counts = self.counts()[trials]
+        offsets = np.concatenate(([0], np.cumsum(counts, dtype=np.int64)))
+        # position of every selected value in self.values
+        idx = np.arange(offsets[-1]) + np.repeat(self.offsets[trials] - offsets[:-1], counts)
+        return RaggedTrials(self.values[idx], offsets)
+
+    def histogram(self, bins):
+        """ Histogram of every trial, as np.histogram(self[i], bins) for each trial -> (trial x bin) """
+        bins = np.asarray(bins, dtype=float)
+        n_bins = len(bins) - 1
+        bin_idx = np.searchsorted(bins, self.values, side='right') - 1
+        bin_idx[self.values == bins[-1]] = n_bins - 1 # last bin includes its right edge
+        is_inside = (bin_idx >= 0) & (bin_idx < n_bins)
+        flat_idx = self.trial_index()[is_inside] * n_bins + bin_idx[is_inside]
+        return np.bincount(flat_idx, minlength=len(self)*n_bins).reshape(len(self), n_bins)
+
+    def tolist(self):
+        """ List of arrays, each a view of values """
+        return list(self)
+
+def lick_binner(paqData, trial_start, stChanName, threshold=1, distance=False, stimulation=False, return_ragged=False):
     ''' makes new easytest binned lick variable in run object 
     ST 06/08/2024: edited to accept lick data 
     directly stored in paqData (i.e. no need to pull out stChanName if stChanName=None)
-    also added optional input threshold to specify your own threshold'''
+    also added optional input threshold to specify your own threshold
+    all trials binned at once with np.searchsorted on the sorted lick times; licks between 
+    trial_start[i] and trial_start[i+1] (inclusive, until the end for the last trial) relative to trial_start[i].
+    return_ragged returns binned_licks as RaggedTrials instead of a list of arrays'''
 
     if stChanName is not None:
         licks = paq_data(paqData, stChanName, threshold=threshold, distance=distance, threshold_ttl=True)
     else:
-        licks = threshold_detect(paq_data, threshold, cutoff=False, distance=distance)
-
-    binned_licks = []
+        licks = threshold_detect(paqData, threshold, cutoff=False, distance=distance)
 
-    for i, t_start in enumerate(trial_start):
-        if i == len(trial_start) - 1:
-            t_end = np.inf
-        else:
-            t_end = trial_start[i+1]
-
-        trial_idx = np.where((licks >= t_start) & (licks <= t_end))[0]
-
-        trial_licks = licks[trial_idx] - t_start
+    sorted_licks = np.sort(licks)
+    t_start = np.asarray(trial_start, dtype=float)
+    t_end = np.append(t_start[1:], np.inf)
 
-        binned_licks.append(trial_licks)
+    first = np.searchsorted(sorted_licks, t_start, side='left')
+    last = np.searchsorted(sorted_licks, t_end, side='right')
+    counts = np.where(np.isnan(t_start) | np.isnan(t_end), 0, np.maximum(last - first, 0))
+    offsets = np.concatenate(([0], np.cumsum(counts, dtype=np.int64)))
+    idx = np.arange(offsets[-1]) + np.repeat(first - offsets[:-1], counts)
+    binned_licks = RaggedTrials(sorted_licks[idx] - np.repeat(t_start, counts), offsets)
 
-    licks = licks
-    # attribute already exists called 'binned_licks' and cannot overwrite it
-    binned_licks_easytest = binned_licks
+    if not return_ragged:
+        binned_licks = binned_licks.tolist()
 
     return licks, binned_licks
 
 def preprocessLicks(unpickledLicks, beh_df, behStr_OnsetTime, preStimTime=None, 
-                    stChanName='lick', lickInterval=160, fRate=2000, rig=False):
+                    stChanName='lick', lickInterval=160, fRate=2000, rig=False, return_ragged=False):
     """ ST 09/24: 
+    return_ragged returns session_lick as RaggedTrials (see lick_binner)
     """
     # unpickledLicks = pd.read_pickle(recordingList[str_lickFileName][ind])
     # beh_df = pd.read_csv(recordingList.behFileName[ind])
@@ -2479,21 +3172,26 @@ def preprocessLicks(unpickledLicks, beh_df, behStr_OnsetTime, preStimTime=None,
 
     trial_startTimes = (beh_df[behStr_OnsetTime] - preStimTime)*fRate
     licks, session_lick = lick_binner(unpickledLicks, trial_startTimes, stChanName, 
-                                      threshold=threshold_lick, distance=lickInterval)
+                                      threshold=threshold_lick, distance=lickInterval, return_ragged=True)
     
     if (preStimTime is not None) and ((rig=='BStim2') or (rig=='BStim4') or (rig=='BStim1')):
         # Remove first lick from all rewarded trials if rig is BStim1/2/4, due to bleedover from reward signal
         #if 1 of these rigs, scrub the false 1st 'lick' in rewarded trials 
-        trials_areRewarded = beh_df['rewardVolume']>0 #true/false series with as many elements as there are trials
-        # print(trials_areRewarded.values)
-        for i in np.where(trials_areRewarded.values==True)[0]: #for rewarded trial indices 
-            if len(session_lick[i]) >0:
-                # reward time in terms of trialStartTimes
-                rewardFrame = (preStimTime + (beh_df['rewardTime'][i] - beh_df['stimulusOnsetTime'][i])) * fRate #beh_df['trialOffsets'] not added here because this is only for BStim experiments
-                postRewardFrame = rewardFrame+(preStimTime*fRate) #look for licks within preRewardTime=3 seconds post-outcome
-                if (np.where(session_lick[i]>rewardFrame) & (session_lick[i]<postRewardFrame)[0]).size != 0: #array of indices in animal_lick with values i.e. timings >rewardFrame and <postRewardFrame
-                    session_lick[i] = np.delete(session_lick[i], np.where((session_lick[i]>rewardFrame))[0][0]) #delete the first lick event after reward onset, because this is just a reward delivery
-    
+        trials_areRewarded = (beh_df['rewardVolume']>0).values #true/false with as many elements as there are trials
+        # reward time in terms of trialStartTimes
+        rewardFrame = ((preStimTime + (beh_df['rewardTime'] - beh_df['stimulusOnsetTime'])) * fRate).values #beh_df['trialOffsets'] not added here because this is only for BStim experiments
+        trial_idx = session_lick.trial_index()
+        is_afterReward = trials_areRewarded[trial_idx] & (session_lick.values > rewardFrame[trial_idx])
+        # delete the first lick event after reward onset in each trial, because this is just a reward delivery
+        n_afterReward = np.cumsum(is_afterReward)
+        n_beforeTrial = np.concatenate(([0], n_afterReward))[session_lick.offsets[:-1]]
+        is_rewardLick = is_afterReward & ((n_afterReward - np.repeat(n_beforeTrial, session_lick.counts())) == 1)
+        counts = session_lick.counts() - np.bincount(trial_idx[is_rewardLick], minlength=len(session_lick))
+        session_lick = RaggedTrials(session_lick.values[~is_rewardLick], np.concatenate(([0], np.cumsum(counts))))
+    
+    if not return_ragged:
+        session_lick = session_lick.tolist()
+
     return licks, session_lick
 
 def dFF_BaselineNormalisation(dff, baselineWindow, expectedDim, axis_time=1, is_cell=None):